@@ -16,7 +16,7 @@ from tkinter import filedialog
 from google import genai
 from google.genai import types
 import pygame_gui
-from pygame_gui.elements import UIButton, UITextEntryLine
+from pygame_gui.elements import UIButton, UITextEntryLine, UISelectionList
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Image
 from reportlab.lib.styles import getSampleStyleSheet
@@ -25,21 +25,201 @@ from collections import Counter
 from datetime import datetime
 import logging
 import threading
-import matplotlib.pyplot as plt  # For generating medical charts
 import json  # add this import near the top
+import hashlib
+import sys
+import argparse
+import contextlib
+import uuid
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+import gc
+import atexit
+import struct
+from collections import deque, defaultdict
+import bisect
+import tempfile
+import io
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import difflib
+import unicodedata
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 GEMINI_API_KEY = ""  # add default value for GEMINI_API_KEY
 screen_diag_in = None
 mm_per_pixel = None
+level_baseline_px = None  # set by compute_font_sizes
+level_font_px = None      # set by compute_font_sizes / adjust_font_sizes
+
+# Pause durations in milliseconds (overridable via "pause_durations_ms" in settings)
+PAUSE_DURATIONS_MS = {
+    "logo": 2000,
+    "instructions": 3000,
+    "cover_eye": 3000,
+    "between_levels": 500,
+    "distance": 3000,
+    "ai_loading": 3000,
+    "complete": 3000,
+}
 
 # ------------------------------
 # Initial Setup
 # ------------------------------
+# Headless runs (benchmarks and reports on build boxes) need no display: use SDL's dummy driver
+HEADLESS_FLAGS = ("--benchmark", "--headless", "--trial-report", "--landmark-analysis", "--probe-camera", "--flush-uploads",
+                  "--ui-asset-report")
+if any(flag in sys.argv for flag in HEADLESS_FLAGS):
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
 pygame.init()
-logging.basicConfig(level=logging.INFO)
+# Set by the multi-station supervisor for each station process
+STATION_ID = os.environ.get("VISIONTEST_STATION")
+DISPLAY_INDEX = int(os.environ.get("VISIONTEST_DISPLAY", "0"))
+if STATION_ID:
+    logging.basicConfig(level=logging.INFO, format=f"[station {STATION_ID}] %(levelname)s:%(name)s:%(message)s")
+else:
+    logging.basicConfig(level=logging.INFO)
 logging.getLogger('mediapipe').setLevel(logging.ERROR)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# ------------------------------
+# Performance Instrumentation
+# ------------------------------
+class StageMetrics:
+    """
+    Per-session latency histograms for hot-path stages. Disabled by default;
+    span() then returns a shared no-op context manager so timing costs nothing.
+    """
+    BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.session_start = time.time()
+            self.histograms = {}
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = {"buckets": [0] * len(self.BUCKETS_S), "count": 0, "sum": 0.0, "max": 0.0}
+            for i, bound in enumerate(self.BUCKETS_S):
+                if seconds <= bound:
+                    hist["buckets"][i] += 1
+                    break
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["max"] = max(hist["max"], seconds)
+
+    def span(self, stage):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _StageSpan(self, stage)
+
+    def to_json(self):
+        with self._lock:
+            stages = {}
+            for stage, hist in self.histograms.items():
+                stages[stage] = {
+                    "count": hist["count"],
+                    "sum_s": round(hist["sum"], 6),
+                    "mean_ms": round(hist["sum"] / hist["count"] * 1000.0, 3),
+                    "max_ms": round(hist["max"] * 1000.0, 3),
+                    "buckets": {str(bound): n for bound, n in zip(self.BUCKETS_S, hist["buckets"])},
+                }
+            return {"session_start": self.session_start, "stages": stages}
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP visiontest_stage_duration_seconds Duration of vision test hot-path stages.",
+            "# TYPE visiontest_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS_S, hist["buckets"]):
+                    cumulative += n
+                    lines.append(f'visiontest_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'visiontest_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+                lines.append(f'visiontest_stage_duration_seconds_sum{{stage="{stage}"}} {hist["sum"]:.6f}')
+                lines.append(f'visiontest_stage_duration_seconds_count{{stage="{stage}"}} {hist["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, folder):
+        """
+        Write the session histograms as JSON and Prometheus text into folder.
+        """
+        if not self.enabled:
+            return None
+        os.makedirs(folder, exist_ok=True)
+        stamp = datetime.fromtimestamp(self.session_start).strftime("%Y%m%d_%H%M%S")
+        json_path = os.path.join(folder, f"metrics_{stamp}.json")
+        try:
+            with open(json_path, "w") as f:
+                json.dump(self.to_json(), f, indent=2)
+            with open(os.path.join(folder, f"metrics_{stamp}.prom"), "w") as f:
+                f.write(self.to_prometheus())
+            logging.info(f"Session metrics exported to {json_path}")
+        except Exception as e:
+            logging.error(f"Error exporting metrics: {e}")
+        return json_path
+
+    def serve(self, port):
+        """
+        Serve /metrics (Prometheus text) and /metrics.json on localhost in a daemon thread.
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.to_json()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Metrics endpoint listening on http://127.0.0.1:{port}/metrics")
+        return server
+
+class _StageSpan:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+_NULL_SPAN = contextlib.nullcontext()
+perf_metrics = StageMetrics()
+
 # ------------------------------
 # Loading Background Images and Loading Screen
 # ------------------------------
@@ -60,13 +240,100 @@ if not os.path.exists(save_folder):
 
 background_path = os.path.join(BASE_DIR, "12.webp")
 loading_path = os.path.join(BASE_DIR, "1356.jpeg")
-background_form = pygame.image.load(os.path.join(BASE_DIR, "12.webp"))
-loading_image = pygame.image.load(os.path.join(BASE_DIR, "1356.jpeg"))
 
 info = pygame.display.Info()
 screen_width, screen_height = info.current_w, info.current_h
-background_form = pygame.transform.scale(background_form, (screen_width, screen_height))
-loading_image = pygame.transform.scale(loading_image, (screen_width, screen_height))
+desktop_sizes = pygame.display.get_desktop_sizes()
+if 0 < DISPLAY_INDEX < len(desktop_sizes):
+    screen_width, screen_height = desktop_sizes[DISPLAY_INDEX]
+
+class UIAssetCache:
+    """
+    Full-screen UI images, decoded on first use, scaled to the requested size
+    and converted to the display's pixel format so blits are plain copies.
+    The converted pixels are also kept on disk, keyed by a hash of the source
+    file, the size and the pixel layout, so later starts skip the decode,
+    scale and format conversion. Surfaces can only be requested once the
+    display mode is set.
+    """
+    def __init__(self, sources, cache_dir):
+        self.sources = sources
+        self.cache_dir = cache_dir
+        self._surfaces = {}
+
+    @staticmethod
+    def _pixel_format():
+        display = pygame.display.get_surface()
+        if display is not None and display.get_bitsize() == 32 and display.get_masks()[:3] == (0xFF0000, 0xFF00, 0xFF):
+            return "BGRA"  # the usual 32-bit display layout, stored as-is
+        return "RGB"
+
+    def _variant_path(self, path, size, pixel_format):
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}_{size[0]}x{size[1]}.{pixel_format.lower()}")
+
+    def load(self, name, size):
+        """
+        Display-format surface for name at size, from the disk cache if present.
+        """
+        path = self.sources[name]
+        pixel_format = self._pixel_format()
+        variant_path = self._variant_path(path, size, pixel_format)
+        if os.path.exists(variant_path):
+            with open(variant_path, "rb") as f:
+                data = f.read()
+            if len(data) == size[0] * size[1] * len(pixel_format):
+                return pygame.image.frombuffer(data, size, pixel_format).convert()
+        surface = pygame.transform.scale(pygame.image.load(path), size).convert()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(variant_path + ".tmp", "wb") as f:
+                f.write(pygame.image.tobytes(surface, pixel_format))
+            os.replace(variant_path + ".tmp", variant_path)
+        except OSError as e:
+            logging.warning(f"Could not cache UI asset {name}: {e}")
+        return surface
+
+    def get(self, name, size=None):
+        size = size or (screen_width, screen_height)
+        key = (name, size)
+        if key not in self._surfaces:
+            self._surfaces[key] = self.load(name, size)
+        return self._surfaces[key]
+
+ui_assets = UIAssetCache({"background": background_path, "loading": loading_path},
+                         os.path.join(BASE_DIR, ".cache", "ui"))
+
+def ui_asset_report(size=None, iterations=200):
+    """
+    Time each UI asset: decode + scale + convert without the cache, load from
+    the disk cache, and a full-screen blit of the unconverted vs display-format surface.
+    """
+    size = size or (screen_width, screen_height)
+    report = {"size": list(size), "assets": {}}
+    for name, path in ui_assets.sources.items():
+        start = time.perf_counter()
+        raw = pygame.transform.scale(pygame.image.load(path), size)
+        raw.convert()
+        uncached_s = time.perf_counter() - start
+        ui_assets.load(name, size)  # make sure the disk variant exists
+        start = time.perf_counter()
+        converted = ui_assets.load(name, size)
+        cached_s = time.perf_counter() - start
+        timings = {}
+        for label, surface in (("unconverted", raw), ("converted", converted)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                screen.blit(surface, (0, 0))
+            timings[label] = 1000.0 * (time.perf_counter() - start) / iterations
+        report["assets"][name] = {
+            "uncached_load_ms": round(1000.0 * uncached_s, 2),
+            "cached_load_ms": round(1000.0 * cached_s, 2),
+            "unconverted_blit_ms": round(timings["unconverted"], 3),
+            "converted_blit_ms": round(timings["converted"], 3),
+        }
+    return report
 
 # ------------------------------
 # Gemini API Configuration Using Environment Variable
@@ -111,12 +378,13 @@ def get_gemini_recommendation(test_summary):
     )
     try:
         response_text = ""
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            response_text += chunk.text
+        with perf_metrics.span("ai_recommendation"):
+            for chunk in client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=generate_content_config,
+            ):
+                response_text += chunk.text
         return response_text
     except Exception as e:
         logging.error(f"Error in Gemini API call: {e}")
@@ -124,6 +392,85 @@ def get_gemini_recommendation(test_summary):
         return "No recommendation available due to internal API error."
 
 
+# ------------------------------
+# Local Recommendation Engine
+# ------------------------------
+NORMAL_LOGMAR = 0.2          # 10/15 or better counts as normal distance acuity
+REFERRAL_LOGMAR = 0.3        # 10/20 or worse in either eye warrants a referral
+AMBLYOPIA_DIFF_LOGMAR = 0.2  # two or more lines between eyes suggests amblyopia
+BORDERLINE_MARGIN_LOGMAR = 0.1
+
+def eye_acuity(correct_levels):
+    """
+    Summarize one eye as its best passed level. A level only counts when the
+    next larger level was passed too, so a single lucky guess at a small
+    optotype does not set the acuity. Returns a dict with snellen and logmar.
+    """
+    passed = np.array([level["snellen"] in correct_levels for level in clinical_levels])
+    confirmed = passed & np.concatenate(([True], passed[:-1]))
+    if not confirmed.any():
+        return {"snellen": f"worse than {clinical_levels[0]['snellen']}", "logmar": float(LEVEL_LOGMAR[0] + 0.1)}
+    best = int(np.flatnonzero(confirmed)[-1])
+    return {"snellen": clinical_levels[best]["snellen"], "logmar": float(LEVEL_LOGMAR[best])}
+
+def _describe_eye(acuity):
+    if acuity["logmar"] <= NORMAL_LOGMAR:
+        grade = "normal distance acuity"
+    elif acuity["logmar"] <= 0.5:
+        grade = "mildly reduced distance acuity"
+    elif acuity["logmar"] <= 1.0:
+        grade = "moderately reduced distance acuity"
+    else:
+        grade = "severely reduced distance acuity"
+    return f"{acuity['snellen']} (logMAR {acuity['logmar']:.2f}), {grade}."
+
+def local_recommendation(left_correct, right_correct):
+    """
+    Rule-based assessment from per-eye acuity, using the same sections as the
+    Gemini prompt. Returns (text, findings); findings["borderline"] is True
+    when a value lies close to a referral threshold.
+    """
+    left, right = eye_acuity(left_correct), eye_acuity(right_correct)
+    worse = max(left["logmar"], right["logmar"])
+    diff = abs(left["logmar"] - right["logmar"])
+    weaker_eye = "left" if left["logmar"] > right["logmar"] else "right"
+    amblyopia_risk = diff >= AMBLYOPIA_DIFF_LOGMAR - 1e-9
+    referral = worse >= REFERRAL_LOGMAR - 1e-9 or amblyopia_risk
+    borderline = (abs(worse - REFERRAL_LOGMAR) < BORDERLINE_MARGIN_LOGMAR
+                  or abs(diff - AMBLYOPIA_DIFF_LOGMAR) < BORDERLINE_MARGIN_LOGMAR)
+    findings = {"left": left, "right": right, "interocular_diff": round(diff, 3),
+                "amblyopia_risk": amblyopia_risk, "referral": referral, "borderline": borderline}
+
+    if diff < 1e-9:
+        comparison = "Both eyes reached the same level."
+    else:
+        comparison = f"The {weaker_eye} eye is {diff:.2f} logMAR weaker than the other eye."
+    amblyopia = f"Yes, {weaker_eye} eye (interocular difference of {diff:.2f} logMAR)." if amblyopia_risk else "No."
+    if worse > NORMAL_LOGMAR:
+        refractive = ("Myopia: reduced distance acuity is consistent with myopia; "
+                      "a refraction test is needed to confirm.")
+    else:
+        refractive = "No myopia risk at distance; hyperopia cannot be excluded by a distance test alone."
+    if referral:
+        doctor = "Yes, schedule a full eye examination with an ophthalmologist or optometrist."
+        conclusion = "Reduced or unequal acuity was found; professional evaluation is recommended."
+    else:
+        doctor = "No, routine screening is sufficient."
+        conclusion = "No significant abnormalities detected."
+    if borderline:
+        conclusion += " Results are close to a referral threshold; consider repeating the test."
+    text = (
+        f"Right Eye: {_describe_eye(right)}\n"
+        f"Left Eye: {_describe_eye(left)}\n"
+        f"Comparison of Right and Left: {comparison}\n"
+        f"Amblyopia Risk (if yes, which eye?): {amblyopia}\n"
+        f"Hyperopia or Myopia Risk: {refractive}\n"
+        f"Need to See a Doctor?: {doctor}\n"
+        f"Brief Conclusion: {conclusion}"
+    )
+    return text, findings
+
+
 # ------------------------------
 # Multi-Camera Support and Specialized Hardware Functions
 # ------------------------------
@@ -161,10 +508,119 @@ def select_camera():
         logging.error(f"Error in camera selection: {e}")
         return cameras[0]
 
+# Candidate capture formats, tried in order by probe_capture_profiles.
+# fourcc None keeps the driver default; buffer_size 1 keeps at most one queued frame.
+CAPTURE_PROFILES = (
+    {"name": "mjpg_640x480_30", "fourcc": "MJPG", "width": 640, "height": 480, "fps": 30, "buffer_size": 1},
+    {"name": "mjpg_1280x720_30", "fourcc": "MJPG", "width": 1280, "height": 720, "fps": 30, "buffer_size": 1},
+    {"name": "yuyv_640x480_30", "fourcc": "YUYV", "width": 640, "height": 480, "fps": 30, "buffer_size": 1},
+    {"name": "default", "fourcc": None, "width": None, "height": None, "fps": None, "buffer_size": None},
+)
+
+def camera_key(camera_index):
+    return f"camera_{camera_index}"
+
+def apply_capture_profile(capture, profile):
+    """
+    Request the profile's format from the driver. FOURCC goes first because
+    it limits which resolutions and frame rates the camera offers.
+    """
+    if profile.get("fourcc"):
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*profile["fourcc"]))
+    if profile.get("width") and profile.get("height"):
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, profile["width"])
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, profile["height"])
+    if profile.get("fps"):
+        capture.set(cv2.CAP_PROP_FPS, profile["fps"])
+    if profile.get("buffer_size"):
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, profile["buffer_size"])
+    return capture
+
+def measure_capture_profile(camera_index, profile, frames=40, warmup=5, idle_s=0.1):
+    """
+    Open the camera with profile and measure what it really delivers: frame
+    size, delivered fps over back-to-back reads, and frame age. Frame age is
+    estimated by idling for idle_s (like a processing step) and counting the
+    reads that then return at once: those frames were already queued, so
+    each one adds a frame interval of lag.
+    """
+    capture = apply_capture_profile(cv2.VideoCapture(camera_index), profile)
+    try:
+        if not capture.isOpened():
+            return None
+        frame = None
+        for _ in range(warmup):
+            ret, frame = capture.read()
+        if frame is None:
+            return None
+        start = time.perf_counter()
+        delivered = sum(1 for _ in range(frames) if capture.read()[0])
+        elapsed = time.perf_counter() - start
+        fps = delivered / elapsed if elapsed > 0 else 0.0
+        if fps <= 0:
+            return None
+        interval_s = 1.0 / fps
+        queued_counts = []
+        for _ in range(5):
+            time.sleep(idle_s)
+            queued = 0
+            while queued < 10:
+                read_start = time.perf_counter()
+                capture.read()
+                if time.perf_counter() - read_start > 0.25 * interval_s:
+                    break
+                queued += 1
+            queued_counts.append(queued)
+        frame_age_ms = 1000.0 * interval_s * sum(queued_counts) / len(queued_counts)
+        return {
+            "profile": profile["name"],
+            "size": [frame.shape[1], frame.shape[0]],
+            "fps": round(fps, 2),
+            "frame_age_ms": round(frame_age_ms, 1),
+            # Expected wait for a fresh frame: queued lag plus one frame interval
+            "latency_ms": round(frame_age_ms + 1000.0 * interval_s, 1),
+        }
+    finally:
+        capture.release()
+
+def probe_capture_profiles(camera_index, min_fps=15.0):
+    """
+    Measure every capture profile on a camera, save the lowest-latency one
+    that reaches min_fps as that camera's profile and return all measurements.
+    """
+    results = []
+    for profile in CAPTURE_PROFILES:
+        measurement = measure_capture_profile(camera_index, profile)
+        logging.info(f"Capture profile {profile['name']} on camera {camera_index}: {measurement}")
+        if measurement is not None:
+            results.append(measurement)
+    usable = [result for result in results if result["fps"] >= min_fps] or results
+    if usable:
+        best = min(usable, key=lambda result: result["latency_ms"])
+        profile = next(p for p in CAPTURE_PROFILES if p["name"] == best["profile"])
+        profiles = dict(settings_store.get("capture_profiles"))
+        profiles[camera_key(camera_index)] = dict(profile, measured=best)
+        settings_store.update(capture_profiles=profiles)
+        logging.info(f"Using capture profile {best['profile']} for camera {camera_index}")
+    return results
+
+def open_camera(camera_index):
+    """
+    Open a camera with its saved capture profile, probing the profiles first
+    if this camera has none yet.
+    """
+    key = camera_key(camera_index)
+    if key not in settings_store.get("capture_profiles"):
+        probe_capture_profiles(camera_index)
+    profile = settings_store.get("capture_profiles").get(key)
+    capture = cv2.VideoCapture(camera_index)
+    return apply_capture_profile(capture, profile) if profile else capture
+
 # ------------------------------
 # Professional PDF Reporting Functions
 # ------------------------------
-def generate_comparison_text(user_folder, left_correct, left_incorrect, right_correct, right_incorrect):
+def generate_comparison_text(user_folder, left_correct, left_incorrect, right_correct, right_incorrect,
+                             previous_results=None):
     import os
 
     # Calculate count for each eye in current test
@@ -173,10 +629,13 @@ def generate_comparison_text(user_folder, left_correct, left_incorrect, right_co
     curr_right_correct = len(right_correct)
     curr_right_incorrect = len(right_incorrect)
 
-    # File storing previous results (for each eye)
+    # File storing previous results (for each eye); skipped when the counts were prefetched
     results_file = os.path.join(user_folder, "previous_results.txt")
     prev_left_correct, prev_left_incorrect, prev_right_correct, prev_right_incorrect = 0, 0, 0, 0
-    if os.path.exists(results_file):
+    if previous_results is not None:
+        if len(previous_results) >= 4:
+            prev_left_correct, prev_left_incorrect, prev_right_correct, prev_right_incorrect = previous_results[:4]
+    elif os.path.exists(results_file):
         try:
             with open(results_file, "r") as f:
                 lines = f.readlines()
@@ -218,10 +677,561 @@ def generate_comparison_text(user_folder, left_correct, left_incorrect, right_co
     return text
 
 
+ACUITY_HISTORY_FILE = "acuity_history.jsonl"
+ACUITY_CHART_VERSION = 1  # bump when the chart layout changes to invalidate cached charts
+
+def append_acuity_history(user_folder, findings):
+    """
+    Append this session's per-eye acuity (from local_recommendation findings)
+    to the patient's acuity history.
+    """
+    os.makedirs(user_folder, exist_ok=True)
+    record = {"date": datetime.now().isoformat(timespec="seconds")}
+    for eye in ("left", "right"):
+        record[eye] = round(findings[eye]["logmar"], 4)
+        record[f"{eye}_snellen"] = findings[eye]["snellen"]
+    with open(os.path.join(user_folder, ACUITY_HISTORY_FILE), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def load_acuity_history(user_folder):
+    history = []
+    history_file = os.path.join(user_folder, ACUITY_HISTORY_FILE)
+    if os.path.exists(history_file):
+        with open(history_file, "r") as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return history
+
+def render_acuity_chart(user_folder):
+    """
+    Draw the patient's logMAR trend per eye to a PNG in user_folder and
+    return its path (None without history). Charts are named by a hash of
+    the history, so an unchanged history reuses the existing file without
+    loading matplotlib. Meant to run in a BackgroundJob; it uses the Agg
+    canvas directly, not pyplot.
+    """
+    history = load_acuity_history(user_folder)
+    if not history:
+        return None
+    digest = hashlib.sha256(json.dumps([ACUITY_CHART_VERSION, history], sort_keys=True).encode()).hexdigest()[:16]
+    chart_path = os.path.join(user_folder, f"acuity_chart_{digest}.png")
+    if os.path.exists(chart_path):
+        return chart_path
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        dates = [datetime.fromisoformat(record["date"]) for record in history]
+        fig = Figure(figsize=(6, 3), dpi=150)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.plot(dates, [record["right"] for record in history], marker="o", label="Right eye")
+        ax.plot(dates, [record["left"] for record in history], marker="s", label="Left eye")
+        ax.axhline(REFERRAL_LOGMAR, color="red", linestyle="--", linewidth=1, label="Referral threshold")
+        ax.invert_yaxis()  # better acuity (lower logMAR) at the top
+        ax.set_ylabel("logMAR (lower is better)")
+        ax.set_title("Visual acuity over time")
+        ax.grid(True, alpha=0.3)
+        ax.legend(loc="best", fontsize="small")
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        fig.savefig(chart_path + ".tmp", format="png")
+        os.replace(chart_path + ".tmp", chart_path)
+    except Exception as e:
+        logging.error(f"Error rendering acuity chart: {e}")
+        return None
+    for name in os.listdir(user_folder):
+        if name.startswith("acuity_chart_") and name.endswith(".png") and name != os.path.basename(chart_path):
+            os.remove(os.path.join(user_folder, name))
+    return chart_path
+
+# ------------------------------
+# Cloud Upload Engine
+# ------------------------------
+UPLOAD_PART_BYTES = 8 * 1024 * 1024     # multipart part size (S3 minimum is 5 MB)
+UPLOAD_SMALL_FILE_BYTES = 1024 * 1024   # files below this are batched into one archive
+UPLOAD_BATCH_BYTES = 16 * 1024 * 1024   # upper bound on a batch archive's input size
+
+class FilesystemUploadBackend:
+    """
+    Local stand-in for an S3-compatible store: objects are files under root
+    and multipart uploads are staged under root/.multipart/<upload_id>/.
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, ".multipart"), exist_ok=True)
+
+    def _object_path(self, key):
+        path = os.path.join(self.root, *key.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, key, data):
+        self._write(self._object_path(key), data)
+
+    def copy(self, src_key, dst_key):
+        with open(self._object_path(src_key), "rb") as f:
+            self.put(dst_key, f.read())
+
+    def start_multipart(self, key):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, ".multipart", upload_id))
+        return upload_id
+
+    def _part_dir(self, upload_id):
+        part_dir = os.path.join(self.root, ".multipart", upload_id)
+        if not os.path.isdir(part_dir):
+            raise KeyError(f"Unknown multipart upload: {upload_id}")
+        return part_dir
+
+    def upload_part(self, key, upload_id, part_number, data):
+        self._write(os.path.join(self._part_dir(upload_id), f"{part_number:05d}"), data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart(self, key, upload_id, parts):
+        part_dir = self._part_dir(upload_id)
+        path = self._object_path(key)
+        tmp_path = f"{path}.{upload_id}.tmp"
+        with open(tmp_path, "wb") as out:
+            for part_number, etag in parts:
+                with open(os.path.join(part_dir, f"{part_number:05d}"), "rb") as f:
+                    data = f.read()
+                if hashlib.md5(data).hexdigest() != etag:
+                    raise ValueError(f"Part {part_number} of {key} does not match its ETag")
+                out.write(data)
+        os.replace(tmp_path, path)
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+    def abort_multipart(self, key, upload_id):
+        shutil.rmtree(os.path.join(self.root, ".multipart", upload_id), ignore_errors=True)
+
+class S3UploadBackend:
+    """
+    S3 or S3-compatible (e.g. MinIO) store through one pooled boto3 client,
+    so connections are reused across parts and threads.
+    """
+    def __init__(self, bucket, prefix="", endpoint_url=None, max_connections=8):
+        import boto3  # optional dependency, only needed for s3:// targets
+        from botocore.config import Config
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None,
+                                   config=Config(max_pool_connections=max_connections))
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def copy(self, src_key, dst_key):
+        self.client.copy_object(Bucket=self.bucket, Key=self.prefix + dst_key,
+                                CopySource={"Bucket": self.bucket, "Key": self.prefix + src_key})
+
+    def start_multipart(self, key):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self.prefix + key)["UploadId"]
+
+    def upload_part(self, key, upload_id, part_number, data):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id,
+                                               PartNumber=part_number, Body=data)
+        except self.client.exceptions.NoSuchUpload as e:
+            raise KeyError(f"Unknown multipart upload: {upload_id}") from e
+        return response["ETag"]
+
+    def complete_multipart(self, key, upload_id, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": n, "ETag": etag} for n, etag in parts]})
+
+    def abort_multipart(self, key, upload_id):
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.prefix + key, UploadId=upload_id)
+        except self.client.exceptions.NoSuchUpload:
+            pass
+
+def make_upload_backend(target, endpoint_url=""):
+    """
+    Build a backend from an upload target: "s3://bucket/prefix" or a local
+    directory ("file:///path" or a plain path). An empty target disables uploads.
+    """
+    if not target:
+        return None
+    if target.startswith("s3://"):
+        bucket, _, prefix = target[len("s3://"):].partition("/")
+        return S3UploadBackend(bucket, prefix, endpoint_url)
+    if target.startswith("file://"):
+        target = target[len("file://"):]
+    return FilesystemUploadBackend(target)
+
+class UploadOutbox:
+    """
+    Persistent upload queue with one entry per object key. Every change to an
+    entry is appended to a JSONL journal, and replaying it restores pending
+    uploads, their multipart ids and the parts already sent after a crash.
+    Finished entries stay (with their hash, size and mtime) so unchanged files
+    are not queued again and identical content can be deduplicated.
+    """
+    def __init__(self, path, compact=True):
+        self.path = path
+        self.entries = {}
+        self._pending = set()
+        self._by_hash = {}
+        self._lock = threading.Lock()
+        self._offset = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = self._read_new()
+        if compact and lines > 2 * len(self.entries):
+            self._compact()
+
+    def _read_new(self):
+        """
+        Replay the journal records appended since the last read (by this or
+        another process). Returns the number of records read.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+        if size < self._offset:  # compacted by another process: replay from the start
+            self.entries, self._pending, self._by_hash, self._offset = {}, set(), {}, 0
+        if size == self._offset:
+            return 0
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # leave a record still being written for the next read
+        self._offset += end
+        lines = 0
+        touched = set()
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+                self.entries.setdefault(record["key"], {}).update(record)
+                touched.add(record["key"])
+                lines += 1
+            except (json.JSONDecodeError, KeyError):
+                continue
+        for key in touched:
+            self._index(self.entries[key])
+        return lines
+
+    def refresh(self):
+        with self._lock:
+            self._read_new()
+
+    def _index(self, entry):
+        if entry.get("state") == "pending":
+            self._pending.add(entry["key"])
+            if self._by_hash.get(entry.get("done_sha")) == entry["key"]:
+                del self._by_hash[entry["done_sha"]]  # the object at key is about to change
+        else:
+            self._pending.discard(entry["key"])
+        if entry.get("state") == "done" and entry.get("sha256"):
+            self._by_hash[entry["sha256"]] = entry["key"]
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for entry in self.entries.values():
+                if entry.get("state") == "done":
+                    entry = {field: value for field, value in entry.items() if field not in ("upload_id", "parts")}
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+        self._offset = os.path.getsize(self.path)
+
+    def _append(self, entry, fields):
+        entry.update(fields)
+        self._index(entry)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(dict(fields, key=entry["key"])) + "\n")
+
+    def update(self, entry, **fields):
+        with self._lock:
+            self._append(entry, fields)
+
+    def add_part(self, entry, part_number, etag):
+        with self._lock:
+            self._append(entry, {"parts": dict(entry.get("parts") or {}, **{str(part_number): etag})})
+
+    def add(self, path, key):
+        """
+        Queue path under key. Skipped when the key is already pending, or was
+        uploaded and the file's size and mtime are unchanged since.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._read_new()
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"key": key}
+            elif entry.get("state") == "pending":
+                return None
+            elif (entry.get("state") == "done" and entry.get("mtime") == stat.st_mtime
+                  and entry.get("size") == stat.st_size):
+                return None
+            previous_sha = entry.get("sha256") if entry.get("state") == "done" else entry.get("done_sha")
+            self._append(entry, {"path": path, "state": "pending", "queued": time.time(), "done_sha": previous_sha,
+                                 "sha256": None, "size": None, "mtime": None})
+        return entry
+
+    def pending(self):
+        with self._lock:
+            return [self.entries[key] for key in self._pending]
+
+    def done_by_hash(self):
+        """
+        {sha256: key} of finished uploads.
+        """
+        with self._lock:
+            return dict(self._by_hash)
+
+class UploadEngine:
+    """
+    Background uploader for the files queued in an UploadOutbox. Large files
+    are sent as multipart uploads with parts spread over a bounded thread pool;
+    small files are batched into zip archives with a manifest. Content already
+    uploaded is not sent again (same key: skipped, other key: server-side copy
+    or a manifest reference). Failures are retried with exponential backoff.
+    Only one process per outbox runs the uploads (the owner, holding
+    <outbox>.lock); others just append to the outbox, which the owner polls.
+    """
+    def __init__(self, backend, outbox_path, root, workers=4, part_bytes=UPLOAD_PART_BYTES,
+                 small_file_bytes=UPLOAD_SMALL_FILE_BYTES, batch_bytes=UPLOAD_BATCH_BYTES,
+                 retry_base_s=1.0, retry_max_s=60.0, poll_s=5.0):
+        self.backend = backend
+        os.makedirs(os.path.dirname(outbox_path), exist_ok=True)
+        self._owner_file = open(outbox_path + ".lock", "a+")
+        self.owner = _lock_file(self._owner_file, blocking=False)
+        if not self.owner:
+            logging.info(f"Another process is running the uploads for {outbox_path}; only queueing here.")
+        self.outbox = UploadOutbox(outbox_path, compact=self.owner)
+        self.root = root
+        self.part_bytes = part_bytes
+        self.small_file_bytes = small_file_bytes
+        self.batch_bytes = batch_bytes
+        self.retry_base_s = retry_base_s
+        self.retry_max_s = retry_max_s
+        self.poll_s = poll_s
+        self.counters = Counter()
+        self._counter_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="upload-engine", daemon=True)
+        if self.owner:
+            self._thread.start()
+
+    def enqueue(self, paths):
+        for path in paths:
+            key = os.path.relpath(path, self.root).replace(os.sep, "/")
+            self.outbox.add(os.path.abspath(path), key)
+        self._idle.clear()
+        self._wake.set()
+
+    def flush(self, timeout=None):
+        """
+        Wait until the outbox is empty; returns False on timeout.
+        """
+        if self.owner:
+            return self._idle.wait(timeout)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.outbox.refresh()
+            if not self.outbox.pending():
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_s if deadline is None else min(self.poll_s, max(0.0, deadline - time.monotonic())))
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self.owner:
+            self._thread.join(timeout=5)
+            _unlock_file(self._owner_file)
+        self._owner_file.close()
+        self._pool.shutdown(wait=False)
+
+    def _count(self, name, amount=1):
+        with self._counter_lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self._counter_lock:
+            return dict(self.counters, pending=len(self.outbox.pending()))
+
+    def _run(self):
+        delay = self.retry_base_s
+        while not self._stopping:
+            self.outbox.refresh()
+            pending = self.outbox.pending()
+            if not pending:
+                if not self._wake.is_set():
+                    self._idle.set()
+                self._wake.wait(self.poll_s)  # also picks up files queued by other processes
+                self._wake.clear()
+                continue
+            try:
+                self._process(pending)
+                delay = self.retry_base_s
+            except Exception as e:
+                self._count("retries")
+                logging.warning(f"Upload failed ({e}); retrying in {delay:.1f}s")
+                self._wake.wait(delay)
+                self._wake.clear()
+                delay = min(delay * 2, self.retry_max_s)
+
+    def _hash(self, entry):
+        """
+        Hash the file (again if it changed since it was hashed); False if it is gone.
+        """
+        try:
+            stat = os.stat(entry["path"])
+        except FileNotFoundError:
+            logging.warning(f"Upload source missing, dropping: {entry['path']}")
+            self.outbox.update(entry, state="missing")
+            return False
+        if entry.get("mtime") != stat.st_mtime or entry.get("size") != stat.st_size:
+            digest = hashlib.sha256()
+            with open(entry["path"], "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            # A changed file restarts its multipart upload; drop the stale parts on the store
+            if entry.get("upload_id"):
+                try:
+                    self.backend.abort_multipart(entry["key"], entry["upload_id"])
+                except Exception as e:
+                    logging.warning(f"Could not abort multipart upload of {entry['key']}: {e}")
+            self.outbox.update(entry, sha256=digest.hexdigest(), size=stat.st_size, mtime=stat.st_mtime,
+                               upload_id=None, parts={})
+        return True
+
+    def _process(self, pending):
+        done_by_hash = self.outbox.done_by_hash()
+        batch, batch_size, batch_hashes, batches, large = [], 0, {}, [], []
+        for entry in pending:
+            if not self._hash(entry):
+                continue
+            if entry["sha256"] == entry.get("done_sha"):
+                self._count("unchanged")
+                self.outbox.update(entry, state="done")
+                continue
+            same_as = done_by_hash.get(entry["sha256"])
+            if entry["size"] >= self.small_file_bytes:
+                if same_as:
+                    self.backend.copy(same_as, entry["key"])
+                    self._count("deduplicated")
+                    self.outbox.update(entry, state="done", same_as=same_as)
+                else:
+                    large.append(entry)
+                continue
+            # Identical small files queued together are stored once per batch
+            same_as = same_as or batch_hashes.get(entry["sha256"])
+            if batch and batch_size + entry["size"] > self.batch_bytes:
+                batches.append(batch)
+                batch, batch_size, batch_hashes = [], 0, {}
+                same_as = done_by_hash.get(entry["sha256"])
+            if not same_as:
+                batch_hashes[entry["sha256"]] = entry["key"]
+            batch.append((entry, same_as))
+            batch_size += 0 if same_as else entry["size"]
+        if batch:
+            batches.append(batch)
+        futures = [self._pool.submit(self._upload_batch, batch) for batch in batches]
+        for entry in large:
+            self._upload_large(entry)
+        for future in futures:
+            future.result()
+
+    def _upload_batch(self, batch):
+        buffer = io.BytesIO()
+        manifest = []
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for entry, same_as in batch:
+                item = {"key": entry["key"], "sha256": entry["sha256"], "size": entry["size"]}
+                if same_as:
+                    item["same_as"] = same_as
+                else:
+                    archive.write(entry["path"], arcname=entry["key"])
+                manifest.append(item)
+            archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        batch_key = "batches/" + hashlib.sha256(json.dumps(manifest).encode()).hexdigest()[:16] + ".zip"
+        self.backend.put(batch_key, buffer.getvalue())
+        self._count("batches")
+        self._count("bytes", buffer.tell())
+        for entry, same_as in batch:
+            self._count("deduplicated" if same_as else "files")
+            self.outbox.update(entry, state="done", batch=batch_key)
+
+    def _upload_large(self, entry):
+        if not entry.get("upload_id"):
+            self.outbox.update(entry, upload_id=self.backend.start_multipart(entry["key"]), parts={})
+        upload_id = entry["upload_id"]
+        part_count = max(1, math.ceil(entry["size"] / self.part_bytes))
+        missing = [n for n in range(1, part_count + 1) if str(n) not in entry["parts"]]
+
+        def send(part_number):
+            with open(entry["path"], "rb") as f:
+                f.seek((part_number - 1) * self.part_bytes)
+                data = f.read(self.part_bytes)
+            etag = self.backend.upload_part(entry["key"], upload_id, part_number, data)
+            self.outbox.add_part(entry, part_number, etag)
+            self._count("parts")
+            self._count("bytes", len(data))
+
+        try:
+            list(self._pool.map(send, missing))
+        except KeyError:
+            # The store no longer knows this upload (e.g. it expired); start over next round
+            self.outbox.update(entry, upload_id=None, parts={})
+            raise
+        parts = sorted((int(n), etag) for n, etag in entry["parts"].items())
+        self.backend.complete_multipart(entry["key"], upload_id, parts)
+        self._count("files")
+        self.outbox.update(entry, state="done")
+
+upload_engine = None
+
+def get_upload_engine():
+    """
+    The upload engine for the configured upload target, created on first use
+    (which also resumes anything left in the outbox). None when no target is set.
+    """
+    global upload_engine
+    if upload_engine is None and settings_store.get("upload_target"):
+        try:
+            backend = make_upload_backend(settings_store.get("upload_target"), settings_store.get("upload_endpoint_url"))
+        except Exception as e:
+            logging.error(f"Error creating upload backend: {e}")
+            return None
+        upload_engine = UploadEngine(backend, os.path.join(save_folder, "outbox.jsonl"), save_folder,
+                                     workers=max(1, settings_store.get("upload_workers")))
+        atexit.register(upload_engine.stop)
+    return upload_engine
+
 def upload_to_cloud(user_folder, pdf_filename):
-    logging.info(f"Uploading {pdf_filename} from folder {user_folder} to the cloud...")
-    # Here we can use a cloud API. For now, we just print a log message as an example
-    # ...
+    """
+    Queue the report and the patient's other session files for upload and
+    return at once; the upload engine sends them in the background.
+    """
+    engine = get_upload_engine()
+    if engine is None:
+        logging.info(f"No upload target configured; {pdf_filename} stays local.")
+        return
+    logging.info(f"Queueing {pdf_filename} and session files from {user_folder} for upload...")
+    engine.enqueue(entry.path for entry in os.scandir(user_folder)
+                   if entry.is_file() and not entry.name.endswith(".tmp"))
 
 # ------------------------------
 # Helper Functions
@@ -236,100 +1246,306 @@ def select_photo():
     root.destroy()
     return file_path if file_path else None
 
+# Photos are shown at 2x2 inch in the PDF report; store them at this DPI
+REPORT_PHOTO_INCHES = 2
+REPORT_PHOTO_DPI = 150
+
+def ingest_photo(photo_path, user_folder):
+    """
+    Decode a patient photo once and store a square, report-sized JPEG thumbnail
+    in the patient folder. Thumbnails are named by the content hash of the
+    source file, so re-submitting the same photo reuses the existing file.
+    Returns the thumbnail path, or None if the photo cannot be read.
+    """
+    if not photo_path or not os.path.exists(photo_path):
+        return None
+    try:
+        with open(photo_path, "rb") as f:
+            data = f.read()
+    except Exception as e:
+        logging.error(f"Error reading photo: {e}")
+        return None
+
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    thumb_path = os.path.join(user_folder, f"photo_{digest}.jpg")
+    if os.path.exists(thumb_path):
+        logging.info(f"Reusing existing photo thumbnail {thumb_path}")
+        return thumb_path
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        logging.error(f"Unable to decode photo {photo_path}")
+        return None
+    side_px = REPORT_PHOTO_INCHES * REPORT_PHOTO_DPI
+    square = crop_to_square(image)
+    if square.shape[0] > side_px:
+        square = cv2.resize(square, (side_px, side_px), interpolation=cv2.INTER_AREA)
+    if not cv2.imwrite(thumb_path, square, [cv2.IMWRITE_JPEG_QUALITY, 90]):
+        logging.error(f"Unable to write photo thumbnail {thumb_path}")
+        return None
+    logging.info(f"Photo thumbnail saved to {thumb_path} ({len(data)} bytes source)")
+    return thumb_path
+
 # ------------------------------
 # Graphics Settings (Settings Menu)
 # ------------------------------
-def is_first_run():
-    # Check for a hidden config file in BASE_DIR
-    config_flag = os.path.join(BASE_DIR, ".visiontest_configured")
-    return not os.path.exists(config_flag)
+def _lock_file(f, blocking=True):
+    """
+    Take an exclusive advisory lock on the open file f (shared between
+    processes). Returns False when blocking is off and another process holds it.
+    """
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+    else:
+        import fcntl
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+    return True
 
-def mark_configured(api_key, new_save_folder, fullscreen):
-    settings_file = os.path.join(BASE_DIR, ".visiontest_settings.json")
-    settings = {
-         "api_key": api_key,
-         "save_folder": new_save_folder,
-         "fullscreen": fullscreen
-    }
+def _unlock_file(f):
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def _file_lock(lock_path):
+    """
+    Exclusive advisory lock on lock_path, held for the with block.
+    """
+    with open(lock_path, "a+") as f:
+        _lock_file(f)
+        try:
+            yield
+        finally:
+            _unlock_file(f)
+
+class SettingsStore:
+    """
+    Single in-memory copy of the persisted settings. Values are validated
+    against SETTINGS_SCHEMA, written atomically (unique temp file + rename), and
+    subscribers are notified only for keys whose value actually changed.
+    Station processes share the file, so a write re-reads it under a file lock
+    and only applies the keys (and, for dict settings, the entries) this
+    process changed.
+    """
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.values = {key: default for key, (_, default) in schema.items()}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def _validate(self, key, value):
+        expected_type, default = self.schema[key]
+        try:
+            if expected_type is float:
+                value = float(value)
+                if value <= 0:
+                    raise ValueError("must be positive")
+            elif not isinstance(value, expected_type):
+                raise TypeError(f"expected {expected_type.__name__}")
+            return value
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Invalid setting {key}={value!r} ({e}); using default {default!r}")
+            return default
+
+    def load(self, legacy_files=None):
+        """
+        Read the settings file once. legacy_files maps a key to a
+        function returning its value from an older separate file (or None).
+        """
+        stored = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    stored = json.load(f)
+            except Exception as e:
+                logging.error(f"Error loading settings: {e}")
+        migrated = False
+        for key, read_legacy in (legacy_files or {}).items():
+            if key not in stored:
+                legacy_value = read_legacy()
+                if legacy_value is not None:
+                    stored[key] = legacy_value
+                    migrated = True
+        changes = {key: value for key, value in stored.items() if key in self.schema}
+        self.update(_persist=migrated, **changes)
+        return self
+
+    def get(self, key):
+        return self.values[key]
+
+    def subscribe(self, keys, callback):
+        """
+        Call callback(changed_keys) now and whenever one of keys changes.
+        """
+        self._subscribers.append((frozenset(keys), callback))
+        callback(set(keys))
+
+    def update(self, _persist=True, **changes):
+        with self._lock:
+            previous = {}
+            for key, value in changes.items():
+                value = self._validate(key, value)
+                if self.values.get(key) != value:
+                    previous[key] = self.values.get(key)
+                    self.values[key] = value
+            changed = set(previous)
+            if changed and _persist:
+                self._write(previous)
+        for keys, callback in self._subscribers:
+            if keys & changed:
+                callback(keys & changed)
+        return changed
+
+    def _write(self, previous):
+        """
+        Merge the keys in previous (key -> value before this change) into the
+        file as it is on disk now, so other processes' changes are kept.
+        """
+        try:
+            with _file_lock(self.path + ".lock"):
+                stored = {}
+                if os.path.exists(self.path):
+                    with open(self.path, "r") as f:
+                        stored = json.load(f)
+                for key, old in previous.items():
+                    new = self.values[key]
+                    if isinstance(new, dict) and isinstance(old, dict) and isinstance(stored.get(key), dict):
+                        merged = dict(stored[key])
+                        merged.update({name: value for name, value in new.items() if old.get(name, object()) != value})
+                        for name in old.keys() - new.keys():
+                            merged.pop(name, None)
+                        stored[key] = merged
+                        self.values[key] = merged
+                    else:
+                        stored[key] = new
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w") as f:
+                        json.dump(stored, f, indent=2)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    with contextlib.suppress(OSError):
+                        os.remove(tmp_path)
+                    raise
+            logging.info("Settings saved successfully.")
+        except Exception as e:
+            logging.error(f"Error saving settings: {e}")
+
+SETTINGS_SCHEMA = {
+    "api_key": (str, os.getenv("GEMINI_API_KEY", "")),
+    "save_folder": (str, os.path.join(BASE_DIR, "results")),
+    "fullscreen": (bool, True),
+    "screen_diag_in": (float, 15.0),
+    "pause_durations_ms": (dict, {}),
+    "camera_focals": (dict, {}),
+    "frame_budget_ms": (float, 60.0),
+    "capture_profiles": (dict, {}),
+    "upload_target": (str, ""),
+    "upload_endpoint_url": (str, ""),
+    "upload_workers": (int, 4),
+    "motion_gate": (bool, False),
+    "configured": (bool, False),
+}
+settings_store = SettingsStore(os.path.join(BASE_DIR, ".visiontest_settings.json"), SETTINGS_SCHEMA)
+
+def _read_legacy_focals():
+    focals_file = os.path.join(BASE_DIR, "camera_focals.json")
+    if not os.path.exists(focals_file):
+        return None
     try:
-         with open(settings_file, "w") as f:
-             json.dump(settings, f)
-         logging.info("Settings saved successfully.")
+        with open(focals_file, "r") as f:
+            return json.load(f)
     except Exception as e:
-         logging.error(f"Error saving settings: {e}")
+        logging.error(f"Error reading focals file: {e}")
+        return None
+
+def _read_legacy_configured_flag():
+    return True if os.path.exists(os.path.join(BASE_DIR, ".visiontest_configured")) else None
+
+def is_first_run():
+    return not settings_store.get("configured")
+
+def mark_configured(api_key, new_save_folder, fullscreen):
+    settings_store.update(api_key=api_key, save_folder=new_save_folder, fullscreen=fullscreen, configured=True)
 
 def compute_font_sizes(distance_m):
     """
-    Calculate font size for each Snellen level based on distance.
-    Stores both a baseline pixel size ('baseline_px') and the current
-    'font_size_px' for each clinical_levels entry.
+    Calculate the baseline optotype pixel size of every Snellen level for the
+    given distance in one vectorized pass. Stores the result in the
+    'level_baseline_px' and 'level_font_px' arrays (indexed like clinical_levels).
     """
-    global mm_per_pixel
+    global mm_per_pixel, level_baseline_px, level_font_px
     if mm_per_pixel is None or mm_per_pixel <= 0:
         logging.error("mm_per_pixel not set or invalid")
         return clinical_levels
 
-    # Visual angle for a 10/10 (baseline) optotype: 5 arc minutes (5/60 deg).
-    # For a Snellen denominator 'd' (10/d), the optotype visual angle scales by d/10.
-    min_baseline_px = 8  # sensible minimum baseline pixel size to keep legible
-
-    for level_data in clinical_levels:
-        # parse denominator from "10/XXX"
-        try:
-            denom = int(level_data["snellen"].split("/")[1])
-        except Exception:
-            denom = 10
-        # visual angle in degrees for this Snellen level
-        angle_deg = (5.0 / 60.0) * (denom / 10.0)
-        # convert visual angle to physical height at distance (use small-angle formula):
-        # height = 2 * distance * tan(angle/2)
-        height_m = 2.0 * distance_m * math.tan(math.radians(angle_deg) / 2.0)
-        height_mm = height_m * 1000.0
-        px_size = max(min_baseline_px, int(round(height_mm / mm_per_pixel)))
-
-        # store baseline and current values
-        level_data["baseline_px"] = px_size
-        level_data["font_size_px"] = px_size
-
-        logging.info(f"Level {level_data['snellen']} baseline set to {px_size}px (height {height_mm:.2f} mm)")
-
+    level_baseline_px = optotype_sizes_px(distance_m, mm_per_pixel)
+    level_font_px = level_baseline_px.copy()
+    logging.info(f"Baseline optotype sizes at {distance_m} m: "
+                 + ", ".join(f"{level['snellen']}={px}px" for level, px in zip(clinical_levels, level_baseline_px)))
     return clinical_levels
 
-
+def optotype_sizes_px(distance_m, mm_per_px, min_px=8):
+    """
+    Return optotype pixel sizes for all levels as an int32 array.
+    distance_m may be a scalar (shape: levels) or an array of distances
+    (shape: distances x levels).
+    """
+    # Visual angle for a 10/10 (baseline) optotype: 5 arc minutes (5/60 deg),
+    # scaled by d/10 for a Snellen denominator 'd'. Physical height at distance
+    # is 2 * distance * tan(angle/2).
+    distance = np.asarray(distance_m, dtype=np.float64)[..., np.newaxis]
+    height_mm = 2000.0 * distance * np.tan(np.radians(LEVEL_VISUAL_ANGLE_DEG) / 2.0)
+    return np.maximum(np.rint(height_mm / mm_per_px), min_px).astype(np.int32)
 
 def load_settings():
-    global GEMINI_API_KEY, save_folder, fullscreen_setting, screen_diag_in, mm_per_pixel
-    # defaults
-    if not GEMINI_API_KEY:
-        GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-    if 'save_folder' not in globals() or not globals()['save_folder']:
-        save_folder = os.path.join(BASE_DIR, "results")
-    if 'fullscreen_setting' not in globals():
-        fullscreen_setting = True
-    if 'screen_diag_in' not in globals() or not screen_diag_in:
-        screen_diag_in = 15.0
-
-    settings_file = os.path.join(BASE_DIR, ".visiontest_settings.json")
-    try:
-        if os.path.exists(settings_file):
-            with open(settings_file, "r") as f:
-                settings = json.load(f)
-            GEMINI_API_KEY = settings.get("api_key", GEMINI_API_KEY)
-            save_folder = settings.get("save_folder", save_folder)
-            fullscreen_setting = settings.get("fullscreen", fullscreen_setting)
-            screen_diag_in = float(settings.get("screen_diag_in", screen_diag_in))
-    except Exception as e:
-        logging.error(f"Error loading settings: {e}")
-
-    info = pygame.display.Info()
-    diag_pixels = math.sqrt(info.current_w**2 + info.current_h**2)
+    """
+    Load the settings store once and subscribe the module state derived from it.
+    """
+    settings_store.load(legacy_files={
+        "camera_focals": _read_legacy_focals,
+        "configured": _read_legacy_configured_flag,
+    })
+    settings_store.subscribe(("api_key", "save_folder", "fullscreen", "pause_durations_ms"), _apply_settings)
+    settings_store.subscribe(("screen_diag_in",), _update_display_metrics)
 
-    if not isinstance(screen_diag_in, (int, float)) or screen_diag_in <= 0:
-        screen_diag_in = 15.0
+def _apply_settings(changed):
+    global GEMINI_API_KEY, save_folder, fullscreen_setting
+    GEMINI_API_KEY = settings_store.get("api_key")
+    save_folder = settings_store.get("save_folder")
+    fullscreen_setting = settings_store.get("fullscreen")
+    PAUSE_DURATIONS_MS.update({name: int(ms) for name, ms in settings_store.get("pause_durations_ms").items()})
+    if "save_folder" in changed:
+        os.makedirs(save_folder, exist_ok=True)
 
+def _update_display_metrics(changed):
+    """
+    Recompute DPI and mm_per_pixel (and the optotype size tables, once they
+    exist) when the screen diagonal changes.
+    """
+    global screen_diag_in, mm_per_pixel
+    screen_diag_in = settings_store.get("screen_diag_in")
+    diag_pixels = math.sqrt(screen_width**2 + screen_height**2)
     dpi = diag_pixels / screen_diag_in
     mm_per_pixel = 25.4 / dpi
-    logging.info(f"Settings loaded: screen_diag_in={screen_diag_in}, DPI={dpi:.2f}, mm_per_pixel={mm_per_pixel:.4f}")
+    logging.info(f"Display metrics: screen_diag_in={screen_diag_in}, DPI={dpi:.2f}, mm_per_pixel={mm_per_pixel:.4f}")
+    if level_baseline_px is not None:
+        compute_font_sizes(test_distance)
 
 def show_settings_menu():
     """
@@ -365,43 +1581,18 @@ def show_settings_menu():
     tk.Entry(root, textvariable=diag_var, width=50).grid(row=3, column=1, padx=5, pady=5)
 
     def save_and_close():
-        global GEMINI_API_KEY, save_folder, fullscreen_setting, screen_diag_in, mm_per_pixel
-        GEMINI_API_KEY = api_key_var.get()
-        save_folder = folder_var.get()
-        fullscreen_setting = fullscreen_var.get()
-        try:
-            screen_diag_in = float(diag_var.get())
-        except:
-            screen_diag_in = 15.0
-        
-        # Calculate mm_per_pixel
-        diag_pixels = math.sqrt(screen_width**2 + screen_height**2)
-        dpi = diag_pixels / screen_diag_in
-        mm_per_pixel = 25.4 / dpi
-        logging.info(f"Settings saved: screen_diag_in={screen_diag_in}, DPI={dpi:.2f}, mm_per_pixel={mm_per_pixel:.4f}")
-        
-        # Save settings
-        settings_file = os.path.join(BASE_DIR, ".visiontest_settings.json")
-        settings = {
-             "api_key": GEMINI_API_KEY,
-             "save_folder": save_folder,
-             "fullscreen": fullscreen_setting,
-             "screen_diag_in": screen_diag_in
-        }
         try:
-             with open(settings_file, "w") as f:
-                 json.dump(settings, f)
-             logging.info("Settings saved successfully.")
-             # Mark as configured so is_first_run() returns False next time
-             config_flag = os.path.join(BASE_DIR, ".visiontest_configured")
-             with open(config_flag, "w") as f:
-                 f.write("configured")
-        except Exception as e:
-             logging.error(f"Error saving settings: {e}")
+            diag = float(diag_var.get())
+        except ValueError:
+            diag = 15.0
+        settings_store.update(
+            api_key=api_key_var.get(),
+            save_folder=folder_var.get(),
+            fullscreen=fullscreen_var.get(),
+            screen_diag_in=diag,
+            configured=True,
+        )
         root.destroy()
-        # Reload settings after closing the dialog
-        load_settings()
-        # Optionally, you can force a redraw or update UI here if needed
 
     tk.Button(root, text="Save Settings", command=save_and_close).grid(row=4, column=0, columnspan=3, pady=10)
     root.mainloop()
@@ -410,7 +1601,8 @@ def show_settings_menu():
 # Camera Calibration with AR (Enhanced)
 # ------------------------------
 def calibrate_camera(camera_index=0, pattern_size=(9, 6), square_size=0.025, num_images=15):
-    cap_calib = cv2.VideoCapture(camera_index)
+    # Same capture profile as the test, so the focal length matches its resolution
+    cap_calib = open_capture(camera_index)
     if not cap_calib.isOpened():
         logging.error("Unable to open camera!")
         return None, None
@@ -473,19 +1665,10 @@ def calibrate_camera(camera_index=0, pattern_size=(9, 6), square_size=0.025, num
     if ret:
         focal_length = camera_matrix[0, 0]  # From calibration matrix
         camera_name = f"camera_{camera_index}"
-        focals_file = os.path.join(BASE_DIR, "camera_focals.json")
-        try:
-            if os.path.exists(focals_file):
-                with open(focals_file, "r") as f:
-                    focals_data = json.load(f)
-            else:
-                focals_data = {}
-            focals_data[camera_name] = focal_length
-            with open(focals_file, "w") as f:
-                json.dump(focals_data, f)
-            logging.info(f"Focal length {focal_length} saved for {camera_name}.")
-        except Exception as e:
-            logging.error(f"Error saving focal length: {e}")
+        focals_data = dict(settings_store.get("camera_focals"))
+        focals_data[camera_name] = float(focal_length)
+        settings_store.update(camera_focals=focals_data)
+        logging.info(f"Focal length {focal_length} saved for {camera_name}.")
         logging.info("Camera calibration successful.")
         return camera_matrix, dist_coeffs
     else:
@@ -500,125 +1683,1226 @@ fullscreen_setting = True
 screen_diag_in = 15.0
 load_settings()  # load settings before creating the screen
 flags = pygame.FULLSCREEN if fullscreen_setting else 0
-screen = pygame.display.set_mode((screen_width, screen_height), flags)
+screen = pygame.display.set_mode((screen_width, screen_height), flags, display=DISPLAY_INDEX)
 pygame.display.set_caption("M-Tech Clinical Vision Test")
 BASE_WIDTH, BASE_HEIGHT = 800, 600
 scale_factor = screen_height / BASE_HEIGHT
 
-def get_scaled_font(size):
-    # Using the average of the horizontal and vertical scale factors based on a base resolution.
-    avg_scale = ((screen_width / BASE_WIDTH) + (screen_height / BASE_HEIGHT)) / 2
-    return pygame.font.SysFont(None, int(size * avg_scale))
+def get_scaled_font(size):
+    # Using the average of the horizontal and vertical scale factors based on a base resolution.
+    avg_scale = ((screen_width / BASE_WIDTH) + (screen_height / BASE_HEIGHT)) / 2
+    return pygame.font.SysFont(None, int(size * avg_scale))
+
+WHITE, BLACK = (255, 255, 255), (0, 0, 0)
+
+clinical_levels = [
+    {"snellen": "10/200"},
+    {"snellen": "10/160"},
+    {"snellen": "10/125"},
+    {"snellen": "10/100"},
+    {"snellen": "10/80"},
+    {"snellen": "10/70"},
+    {"snellen": "10/60"},
+    {"snellen": "10/50"},
+    {"snellen": "10/40"},
+    {"snellen": "10/30"},
+    {"snellen": "10/25"},
+    {"snellen": "10/20"},
+    {"snellen": "10/15"},
+    {"snellen": "10/10"},
+]
+test_distance = 1  # Standard test distance in meters
+
+# Level table as arrays (same order as clinical_levels)
+SNELLEN_DENOMINATORS = np.array([int(level["snellen"].split("/")[1]) for level in clinical_levels], dtype=np.float64)
+LEVEL_LOGMAR = np.log10(SNELLEN_DENOMINATORS / 10.0)
+LEVEL_VISUAL_ANGLE_DEG = (5.0 / 60.0) * (SNELLEN_DENOMINATORS / 10.0)
+
+
+mp_hands = mp.solutions.hands
+def build_hands_detector(model_complexity=1):
+    return mp_hands.Hands(
+        static_image_mode=False,
+        max_num_hands=1,
+        model_complexity=model_complexity,
+        min_detection_confidence=0.7,
+        min_tracking_confidence=0.5
+    )
+
+hands_detector = build_hands_detector()
+cap = None  # Will be initialized after camera selection
+mp_face_detection = mp.solutions.face_detection
+face_detection = mp_face_detection.FaceDetection(min_detection_confidence=0.7)
+
+# ------------------------------
+# Adaptive Inference Quality
+# ------------------------------
+# From best to cheapest: hand model complexity, longest side of the frame
+# given to MediaPipe (None = full crop), and run face detection every Nth frame.
+QUALITY_LEVELS = (
+    {"model_complexity": 1, "max_side": None, "face_every": 1},
+    {"model_complexity": 1, "max_side": 480, "face_every": 2},
+    {"model_complexity": 0, "max_side": 360, "face_every": 3},
+    {"model_complexity": 0, "max_side": 256, "face_every": 4},
+)
+
+class QualityController:
+    """
+    Keeps per-frame inference latency within a frame-time budget. After each
+    window of frames the mean latency is compared with the budget: over it,
+    the next cheaper quality level is used; under headroom x budget, the next
+    better one. The window restarts after every change so each level is
+    judged on its own frames.
+    """
+    def __init__(self, budget_ms, window=30, headroom=0.6):
+        self.budget_ms = budget_ms
+        self.window = window
+        self.headroom = headroom
+        self.changes = []
+        self._latencies = deque(maxlen=window)
+        self.reset()
+
+    def reset(self, adaptive=True):
+        """
+        Back to full quality with no face result cached. With adaptive=False
+        the level stays fixed (used for like-for-like benchmark passes).
+        """
+        self.adaptive = adaptive
+        self.level = 0
+        self._latencies.clear()
+        self._face_countdown = 0
+        self._face_results = None
+
+    @property
+    def max_side(self):
+        return QUALITY_LEVELS[self.level]["max_side"]
+
+    def observe(self, latency_s):
+        if not self.adaptive:
+            return
+        self._latencies.append(latency_s)
+        if len(self._latencies) < self.window:
+            return
+        mean_ms = 1000.0 * sum(self._latencies) / len(self._latencies)
+        if mean_ms > self.budget_ms and self.level < len(QUALITY_LEVELS) - 1:
+            self.set_level(self.level + 1, mean_ms)
+        elif mean_ms < self.headroom * self.budget_ms and self.level > 0:
+            self.set_level(self.level - 1, mean_ms)
+        self._latencies.clear()
+
+    def set_level(self, level, mean_ms=None):
+        global hands_detector
+        previous = QUALITY_LEVELS[self.level]
+        if QUALITY_LEVELS[level]["model_complexity"] != previous["model_complexity"]:
+            hands_detector.close()
+            hands_detector = build_hands_detector(QUALITY_LEVELS[level]["model_complexity"])
+        reason = f"mean {mean_ms:.1f} ms, " if mean_ms is not None else ""
+        logging.info(f"Inference quality level {self.level} -> {level} "
+                     f"({reason}budget {self.budget_ms:.1f} ms): {QUALITY_LEVELS[level]}")
+        self.changes.append({"time": time.time(), "from": self.level, "to": level,
+                             "mean_ms": round(mean_ms, 2) if mean_ms is not None else None})
+        self.level = level
+        self._face_countdown = 0
+
+    def face_detections(self, frame_rgb):
+        """
+        Face detection result for this frame, rerun every face_every frames and
+        reused in between (the bounding box is relative, so it is valid at any
+        inference resolution).
+        """
+        if self._face_countdown <= 0 or self._face_results is None:
+            self._face_results = face_detection.process(frame_rgb)
+            self._face_countdown = QUALITY_LEVELS[self.level]["face_every"]
+        self._face_countdown -= 1
+        return self._face_results
+
+    def stats(self):
+        return {"level": self.level, "budget_ms": self.budget_ms, **QUALITY_LEVELS[self.level],
+                "changes": list(self.changes)}
+
+quality_controller = QualityController(settings_store.get("frame_budget_ms"))
+settings_store.subscribe(("frame_budget_ms",),
+                         lambda changed: setattr(quality_controller, "budget_ms", settings_store.get("frame_budget_ms")))
+
+def reset_inference_state(adaptive=True):
+    """
+    Fresh hand tracking graph and full inference quality, so a benchmark pass
+    does not inherit tracking state or a degraded level from an earlier pass.
+    """
+    global hands_detector
+    hands_detector.close()
+    hands_detector = build_hands_detector()
+    quality_controller.reset(adaptive)
+
+calibrated_camera_matrix = None
+calibrated_dist_coeffs = None
+
+user_name = user_surname = user_age = ""
+national_id = ""
+phone = ""
+email = ""
+photo_path = None
+left_eye_correct, left_eye_incorrect = [], []
+right_eye_correct, right_eye_incorrect = [], []
+gemini_recommendation = "No recommendation."
+session_id = None
+session_trials = []  # per-trial timing and sample counts for the current session
+
+KEY_DIRECTIONS = {pygame.K_UP: 90, pygame.K_RIGHT: 0, pygame.K_DOWN: 270, pygame.K_LEFT: 180}
+DIRECTION_NAMES = {0: "Right", 90: "Up", 180: "Left", 270: "Down"}
+# Registration form: patient record field -> form entry, and the fields searched while typing
+FORM_FIELDS = {"name": "name_entry", "surname": "surname_entry", "age": "age_entry",
+               "national_id": "national_id_entry", "phone": "phone_entry", "email": "email_entry"}
+LOOKUP_FIELDS = {"name": "name_entry", "surname": "surname_entry", "national_id": "national_id_entry",
+                 "phone": "phone_entry", "email": "email_entry"}
+
+def crop_to_square(frame):
+    h, w, _ = frame.shape
+    side = min(w, h)
+    start_x = (w - side) // 2
+    start_y = (h - side) // 2
+    return frame[start_y:start_y+side, start_x:start_x+side]
+
+def get_finger_direction(landmarks, mcp_index, tip_index):
+    mcp = landmarks.landmark[mcp_index]
+    tip = landmarks.landmark[tip_index]
+    dx, dy = tip.x - mcp.x, tip.y - mcp.y
+    angle = math.degrees(math.atan2(-dy, dx))
+    angle = angle if angle >= 0 else angle + 360
+    if angle >= 315 or angle < 45:
+        return 0
+    elif 45 <= angle < 135:
+        return 90
+    elif 135 <= angle < 225:
+        return 180
+    else:
+        return 270
+
+def _mark_stage(stage_times, stage, start):
+    """
+    Record the time elapsed since start under stage (in stage_times if given,
+    and in perf_metrics when enabled) and return the current perf_counter value for the next stage.
+    """
+    now = time.perf_counter()
+    if stage_times is not None:
+        stage_times.setdefault(stage, []).append(now - start)
+    perf_metrics.observe(stage, now - start)
+    return now
+
+def get_extended_hand_direction(frame, stage_times=None, rgb_buffer=None):
+    """
+    Return the direction (0, 90, 180, 270) the extended hand points to, or None.
+    If stage_times is a dict, per-stage durations in seconds are appended to it
+    under 'cvtColor', 'hands', 'face' and 'classification'. rgb_buffer is an
+    optional preallocated square array the RGB conversion is written into.
+    """
+    return detect_hand(frame, stage_times, rgb_buffer)[0]
+
+_resize_buffers = {}  # max_side -> preallocated BGR buffer for degraded quality levels
+
+def detect_hand(frame, stage_times=None, rgb_buffer=None):
+    """
+    Like get_extended_hand_direction, but returns (direction or None,
+    (21, 3) float32 landmarks or None). When this process is connected to a
+    shared inference server, the frame is sent there instead.
+    """
+    if inference_client is not None:
+        return inference_client.get_direction(frame)
+    start = frame_start = time.perf_counter()
+    square_frame = crop_to_square(frame)
+    max_side = quality_controller.max_side
+    if max_side is not None and square_frame.shape[0] > max_side:
+        resized = _resize_buffers.get(max_side)
+        if resized is None:
+            resized = _resize_buffers[max_side] = np.empty((max_side, max_side, 3), dtype=np.uint8)
+        square_frame = cv2.resize(square_frame, (max_side, max_side), dst=resized, interpolation=cv2.INTER_AREA)
+        if rgb_buffer is not None and rgb_buffer.size >= resized.size:
+            # The leading part of the slot's buffer, viewed at the reduced size (still contiguous)
+            rgb_buffer = rgb_buffer.reshape(-1)[:resized.size].reshape(resized.shape)
+    if rgb_buffer is not None and rgb_buffer.shape == square_frame.shape:
+        frame_rgb = cv2.cvtColor(square_frame, cv2.COLOR_BGR2RGB, dst=rgb_buffer)
+    else:
+        frame_rgb = cv2.cvtColor(square_frame, cv2.COLOR_BGR2RGB)
+    start = _mark_stage(stage_times, "cvtColor", start)
+    direction, hand_landmarks = classify_hand_rgb(frame_rgb, stage_times, start)
+    quality_controller.observe(time.perf_counter() - frame_start)
+    return direction, landmarks_to_array(hand_landmarks) if hand_landmarks is not None else None
+
+def classify_hand_rgb(frame_rgb, stage_times=None, start=None):
+    """
+    Run hand (and, if a hand is found, face) inference on a square RGB frame.
+    Returns (direction or None, hand landmarks or None). A hand in front of
+    the face is not counted as a direction.
+    """
+    if start is None:
+        start = time.perf_counter()
+    results = hands_detector.process(frame_rgb)
+    start = _mark_stage(stage_times, "hands", start)
+    if results.multi_hand_landmarks:
+        hand_landmarks = results.multi_hand_landmarks[0]
+        h, w, _ = frame_rgb.shape
+        xs = [lm.x for lm in hand_landmarks.landmark]
+        ys = [lm.y for lm in hand_landmarks.landmark]
+        hand_center_x = sum(xs) / len(xs) * w
+        hand_center_y = sum(ys) / len(ys) * h
+
+        face_results = quality_controller.face_detections(frame_rgb)
+        start = _mark_stage(stage_times, "face", start)
+        if face_results.detections:
+            detection = face_results.detections[0]
+            bbox = detection.location_data.relative_bounding_box
+            face_x = bbox.xmin * w
+            face_y = bbox.ymin * h
+            face_width = bbox.width * w
+            face_height = bbox.height * h
+            if face_x <= hand_center_x <= face_x + face_width and face_y <= hand_center_y <= face_y + face_height:
+                return None, hand_landmarks
+
+        directions = []
+        for mcp, tip in [(5, 8), (9, 12), (13, 16), (17, 20)]:
+            directions.append(get_finger_direction(hand_landmarks, mcp, tip))
+        direction = Counter(directions).most_common(1)[0][0]
+        _mark_stage(stage_times, "classification", start)
+        return direction, hand_landmarks
+    return None, None
+
+def average_hand_direction(duration=0.5, trial_stats=None):
+    """
+    Majority vote of hand directions over a short capture window.
+    If trial_stats is a dict, its 'frames' and 'samples' counters are increased.
+    """
+    samples = []
+    frames = 0
+    start_time = time.time()
+    while time.time() - start_time < duration:
+        with perf_metrics.span("frame_capture"):
+            slot = frame_transport.capture(cap)
+        if slot is None:
+            continue
+        frames += 1
+        if settings_store.get("motion_gate"):
+            direction, landmarks = motion_gate.detect(slot.bgr, rgb_buffer=slot.rgb)
+            reused = motion_gate.last_reused
+        else:
+            direction, landmarks = detect_hand(slot.bgr, rgb_buffer=slot.rgb)
+            reused = False
+        # A reused result belongs to an earlier frame: vote with it, but record only fresh ones
+        if session_recorder is not None and not reused:
+            session_recorder.submit(slot, landmarks)
+        if archive_landmarks and landmarks is not None and not reused:
+            session_landmarks.append((len(session_trials), time.time(), landmarks, direction))
+        slot.release()
+        if direction is not None:
+            samples.append(direction)
+        time.sleep(0.05)
+    if trial_stats is not None:
+        trial_stats["frames"] += frames
+        trial_stats["samples"] += len(samples)
+    with perf_metrics.span("direction_voting"):
+        return Counter(samples).most_common(1)[0][0] if samples else None
+
+# ------------------------------
+# Motion-Gated Inference
+# ------------------------------
+MOTION_GATE_SIZE = (64, 48)      # downsampled frame compared between frames
+MOTION_PIXEL_DELTA = 12          # gray-level change that counts a pixel as moving
+MOTION_AREA_FRACTION = 0.005     # fraction of moving pixels that reopens inference
+MOTION_GATE_MAX_REUSE = 10       # force a full inference after this many reused frames
+
+class MotionGate:
+    """
+    Skips hand/face inference on frames that barely differ from the frame the
+    last inference ran on, reusing that result instead. The comparison is made
+    against the last inferred frame (not the previous frame) so slow drift
+    still reopens the gate. last_reused tells whether the latest detect()
+    returned a reused result.
+    """
+    def __init__(self, size=MOTION_GATE_SIZE, pixel_delta=MOTION_PIXEL_DELTA,
+                 area_fraction=MOTION_AREA_FRACTION, max_reuse=MOTION_GATE_MAX_REUSE):
+        self.size = size
+        self.pixel_delta = pixel_delta
+        self.min_moving = max(1, int(area_fraction * size[0] * size[1]))
+        self.max_reuse = max_reuse
+        self._small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+        self._gray = np.empty((size[1], size[0]), dtype=np.uint8)
+        self._diff = np.empty_like(self._gray)
+        self.reset()
+        self.frames = self.hits = 0
+        self.inference_s = 0.0
+        self.gate_s = 0.0
+
+    def reset(self):
+        """
+        Drop the cached result, e.g. when a new stimulus is shown.
+        """
+        self._reference = None
+        self._result = None
+        self._reused = 0
+        self.last_reused = False
+
+    def _moved(self, frame):
+        cv2.resize(frame, self.size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        if self._reference is None:
+            return True
+        cv2.absdiff(self._gray, self._reference, dst=self._diff)
+        return np.count_nonzero(self._diff > self.pixel_delta) >= self.min_moving
+
+    def detect(self, frame, stage_times=None, rgb_buffer=None):
+        """
+        Drop-in for detect_hand: returns (direction, landmarks), either freshly
+        inferred or reused from the last inferred frame when nothing moved.
+        """
+        start = time.perf_counter()
+        moved = self._moved(frame)
+        self.gate_s += time.perf_counter() - start
+        self.frames += 1
+        if not moved and self._result is not None and self._reused < self.max_reuse:
+            self.hits += 1
+            self._reused += 1
+            self.last_reused = True
+            return self._result
+        start = time.perf_counter()
+        self._result = detect_hand(frame, stage_times, rgb_buffer)
+        self.inference_s += time.perf_counter() - start
+        self._reference = self._gray.copy()
+        self._reused = 0
+        self.last_reused = False
+        return self._result
+
+    def stats(self):
+        """
+        Hit rate and estimated inference time saved (hits x mean inference time).
+        """
+        inferred = self.frames - self.hits
+        mean_inference_s = self.inference_s / inferred if inferred else 0.0
+        return {
+            "frames": self.frames,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.frames, 4) if self.frames else 0.0,
+            "inference_saved_s": round(self.hits * mean_inference_s - self.gate_s, 4),
+            "gate_overhead_s": round(self.gate_s, 4),
+        }
+
+motion_gate = MotionGate()
+
+# ------------------------------
+# Shared-Memory Frame Transport
+# ------------------------------
+class FrameSlot:
+    """
+    One preallocated frame buffer: the mirrored BGR camera frame and the RGB
+    square crop handed to inference. Readers retain() a slot while they use it
+    and release() it afterwards.
+    """
+    __slots__ = ("transport", "index", "bgr", "rgb")
+
+    def __init__(self, transport, index, bgr, rgb):
+        self.transport = transport
+        self.index = index
+        self.bgr = bgr
+        self.rgb = rgb
+
+    def retain(self):
+        self.transport._retain(self.index)
+        return self
+
+    def release(self):
+        self.transport._release(self.index)
+
+class FrameTransport:
+    """
+    Reference-counted frame slots in one shared-memory block. capture() reads
+    straight into a free slot and mirrors it in place, so capture, inference
+    and recording all use the same memory and steady-state capture allocates
+    no new frame arrays. Buffers are reallocated only when the frame size changes.
+    """
+    def __init__(self, num_slots=4):
+        self.num_slots = num_slots
+        self.shape = None
+        self.slots = []
+        self._shm = None
+        self._refcounts = [0] * num_slots
+        self._lock = threading.Lock()
+        self._gc_start = gc.get_stats()[0]["collections"]
+        self.counters = {"frames": 0, "allocations": 0, "copies": 0, "dropped": 0}
+
+    def _allocate(self, shape):
+        h, w, _ = shape
+        side = min(h, w)
+        bgr_bytes, rgb_bytes = h * w * 3, side * side * 3
+        slot_bytes = bgr_bytes + rgb_bytes
+        old_shm = self._shm
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.num_slots)
+        self.slots = [
+            FrameSlot(
+                self, i,
+                np.ndarray((h, w, 3), dtype=np.uint8, buffer=self._shm.buf, offset=i * slot_bytes),
+                np.ndarray((side, side, 3), dtype=np.uint8, buffer=self._shm.buf, offset=i * slot_bytes + bgr_bytes),
+            )
+            for i in range(self.num_slots)
+        ]
+        self._refcounts = [0] * self.num_slots
+        self.shape = tuple(shape)
+        self.counters["allocations"] += 1
+        if old_shm is not None:
+            self._dispose(old_shm)
+        logging.info(f"Frame transport allocated {self.num_slots} slots for {w}x{h} frames")
+
+    @staticmethod
+    def _dispose(shm):
+        try:
+            shm.close()
+        except BufferError:
+            pass  # a stale view is still alive; the mapping is freed with it
+        shm.unlink()
+
+    def _acquire(self):
+        with self._lock:
+            for i, count in enumerate(self._refcounts):
+                if count == 0:
+                    self._refcounts[i] = 1
+                    return self.slots[i]
+        self.counters["dropped"] += 1
+        return None
+
+    def _retain(self, index):
+        with self._lock:
+            self._refcounts[index] += 1
+
+    def _release(self, index):
+        with self._lock:
+            self._refcounts[index] = max(0, self._refcounts[index] - 1)
+
+    def capture(self, source):
+        """
+        Read the next frame from source (a cv2.VideoCapture or ReplayCapture)
+        into a free slot and mirror it in place. Returns the slot, retained
+        once for the caller, or None if no frame was read or all slots are busy.
+        """
+        if self._shm is None:
+            ret, frame = source.read()
+            if not ret:
+                return None
+            self._allocate(frame.shape)
+            slot = self._acquire()
+            np.copyto(slot.bgr, frame)
+        else:
+            slot = self._acquire()
+            if slot is None:
+                return None
+            ret, frame = source.read(slot.bgr)
+            if not ret:
+                slot.release()
+                return None
+            if frame is not slot.bgr:
+                if frame.shape != self.shape:
+                    slot.release()
+                    with self._lock:
+                        busy = any(self._refcounts)
+                    if busy:
+                        self.counters["dropped"] += 1
+                        return None
+                    self._allocate(frame.shape)
+                    slot = self._acquire()
+                np.copyto(slot.bgr, frame)
+                self.counters["copies"] += 1
+        cv2.flip(slot.bgr, 1, dst=slot.bgr)
+        self.counters["frames"] += 1
+        return slot
+
+    def stats(self):
+        return dict(self.counters, gc_collections=gc.get_stats()[0]["collections"] - self._gc_start)
+
+    def close(self):
+        if self._shm is not None:
+            self.slots = []
+            self._dispose(self._shm)
+            self._shm = None
+
+frame_transport = FrameTransport()
+atexit.register(frame_transport.close)
+
+# ------------------------------
+# Session Recording (Audit Trail)
+# ------------------------------
+# Recording container (.vtrec): an 8-byte magic, then chunks of
+# <type:1s><trial:uint32><timestamp:float64><length:uint32><payload>, then a
+# JSON per-trial index followed by <index offset:uint64><footer magic:8s>.
+# Chunk types: B = trial begin (JSON), F = JPEG frame, L = float32 (21, 3)
+# landmarks (empty payload: no hand), E = trial end (JSON).
+RECORDING_MAGIC = b"VTREC001"
+RECORDING_FOOTER_MAGIC = b"VTRECIDX"
+RECORDING_CHUNK = struct.Struct("<cIdI")
+RECORDING_FOOTER = struct.Struct("<Q8s")
+
+class SessionRecorder:
+    """
+    Records the response window of each trial (downsampled JPEG frames plus
+    raw landmarks) to a chunked .vtrec file. submit() never blocks: frames are
+    encoded and written by a background thread, and when more than max_pending
+    frames are waiting the newest (or, with drop_policy="oldest", the oldest)
+    frame is dropped and counted. Trial markers and landmarks are never dropped.
+    """
+    def __init__(self, path, max_pending=2, max_side=240, jpeg_quality=70, drop_policy="newest"):
+        self.path = path
+        self.max_pending = max_pending
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.drop_policy = drop_policy
+        self.trial = None
+        self.dropped_frames = 0
+        self.written_frames = 0
+        self._items = deque()
+        self._pending_frames = 0
+        self._cond = threading.Condition()
+        self._index = {}
+        self._file = open(path, "wb")
+        self._file.write(RECORDING_MAGIC)
+        self._thread = threading.Thread(target=self._writer, name="session-recorder", daemon=True)
+        self._thread.start()
+
+    def begin_trial(self, trial, meta):
+        self.trial = trial
+        self._enqueue(("B", trial, time.time(), meta))
+
+    def end_trial(self, meta):
+        if self.trial is not None:
+            self._enqueue(("E", self.trial, time.time(), meta))
+        self.trial = None
+
+    def submit(self, slot, landmarks):
+        """
+        Queue a captured frame slot and its landmarks for the current trial.
+        Outside a trial nothing is recorded.
+        """
+        if self.trial is None:
+            return
+        now = time.time()
+        self._enqueue(("L", self.trial, now, landmarks))
+        with self._cond:
+            if self._pending_frames >= self.max_pending:
+                if self.drop_policy != "oldest":
+                    self.dropped_frames += 1
+                    return
+                for item in self._items:
+                    if item[0] == "F":
+                        self._items.remove(item)
+                        item[3].release()
+                        self._pending_frames -= 1
+                        self.dropped_frames += 1
+                        break
+            self._items.append(("F", self.trial, now, slot.retain()))
+            self._pending_frames += 1
+            self._cond.notify()
+
+    def _enqueue(self, item):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def _write_chunk(self, kind, trial, timestamp, payload):
+        offset = self._file.tell()
+        self._file.write(RECORDING_CHUNK.pack(kind.encode("ascii"), trial, timestamp, len(payload)))
+        self._file.write(payload)
+        return offset
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                item = self._items.popleft()
+                if item is not None and item[0] == "F":
+                    self._pending_frames -= 1
+            if item is None:
+                break
+            kind, trial, timestamp, data = item
+            try:
+                if kind == "F":
+                    try:
+                        payload = self._encode_frame(data.bgr)
+                    finally:
+                        data.release()
+                    self.written_frames += 1
+                    self._index[trial]["frames"] += 1
+                elif kind == "L":
+                    payload = data.astype(np.float32).tobytes() if data is not None else b""
+                else:
+                    payload = json.dumps(data).encode("utf-8")
+                offset = self._write_chunk(kind, trial, timestamp, payload)
+                if kind == "B":
+                    self._index[trial] = {"offset": offset, "frames": 0, "meta": dict(data)}
+                elif kind == "E":
+                    self._index[trial]["meta"].update(data)
+                    self._index[trial]["end"] = self._file.tell()
+            except Exception as e:
+                logging.error(f"Error writing recording chunk: {e}")
+
+    def _encode_frame(self, frame):
+        h, w, _ = frame.shape
+        scale = self.max_side / max(h, w)
+        if scale < 1.0:
+            frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return encoded.tobytes() if ok else b""
+
+    def close(self):
+        """
+        Flush pending items, write the per-trial index and close the file.
+        """
+        with self._cond:
+            self._items.append(None)
+            self._cond.notify()
+        self._thread.join()
+        index = {
+            "trials": {str(trial): entry for trial, entry in self._index.items()},
+            "frames": self.written_frames,
+            "dropped_frames": self.dropped_frames,
+        }
+        index_offset = self._file.tell()
+        self._file.write(json.dumps(index).encode("utf-8"))
+        self._file.write(RECORDING_FOOTER.pack(index_offset, RECORDING_FOOTER_MAGIC))
+        self._file.close()
+        logging.info(f"Recording saved to {self.path}: {self.written_frames} frames, {self.dropped_frames} dropped")
+        return index
+
+def read_recording_index(path):
+    """
+    Return the per-trial index of a .vtrec file. A recording that was not
+    closed (no footer) is indexed by scanning its chunks instead.
+    """
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size >= len(RECORDING_MAGIC) + RECORDING_FOOTER.size:
+            f.seek(-RECORDING_FOOTER.size, os.SEEK_END)
+            index_offset, magic = RECORDING_FOOTER.unpack(f.read(RECORDING_FOOTER.size))
+            if magic == RECORDING_FOOTER_MAGIC:
+                f.seek(index_offset)
+                return json.loads(f.read(size - RECORDING_FOOTER.size - index_offset))
+        logging.warning(f"{path} has no index (recording was not closed); rebuilding it from the chunks")
+        return _scan_recording_index(f, size)
+
+def _scan_recording_index(f, size):
+    f.seek(0)
+    if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+        raise ValueError("not a .vtrec recording")
+    trials, frames = {}, 0
+    while True:
+        offset = f.tell()
+        header = f.read(RECORDING_CHUNK.size)
+        if len(header) < RECORDING_CHUNK.size:
+            break
+        kind, trial, timestamp, length = RECORDING_CHUNK.unpack(header)
+        if kind not in (b"B", b"E", b"F", b"L") or offset + RECORDING_CHUNK.size + length > size:
+            break  # truncated or partly written chunk
+        payload = f.read(length)
+        if kind == b"B":
+            trials[str(trial)] = {"offset": offset, "frames": 0, "meta": json.loads(payload)}
+        elif str(trial) not in trials:
+            continue
+        elif kind == b"F":
+            trials[str(trial)]["frames"] += 1
+            frames += 1
+        elif kind == b"E":
+            trials[str(trial)]["meta"].update(json.loads(payload))
+            trials[str(trial)]["end"] = f.tell()
+    return {"trials": trials, "frames": frames, "dropped_frames": None}
+
+def load_trial_recording(path, trial):
+    """
+    Seek to one trial and return its begin/end metadata plus a list of
+    (timestamp, decoded frame) and (timestamp, landmarks or None) entries.
+    """
+    entry = read_recording_index(path)["trials"][str(trial)]
+    frames, landmarks = [], []
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        while f.tell() < entry.get("end", float("inf")):
+            header = f.read(RECORDING_CHUNK.size)
+            if len(header) < RECORDING_CHUNK.size:
+                break
+            kind, chunk_trial, timestamp, length = RECORDING_CHUNK.unpack(header)
+            payload = f.read(length)
+            if chunk_trial != trial:
+                continue
+            if kind == b"F":
+                frames.append((timestamp, cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)))
+            elif kind == b"L":
+                landmarks.append((timestamp, np.frombuffer(payload, dtype=np.float32).reshape(21, 3) if payload else None))
+            elif kind == b"E":
+                break
+    return {"meta": entry["meta"], "frames": frames, "landmarks": landmarks}
+
+session_recorder = None  # SessionRecorder while a recorded test is running
+recording_enabled = False  # set by --record
+
+# ------------------------------
+# Landmark Archive (Offline Analytics)
+# ------------------------------
+# Append-only columnar store: one raw file per column, all fixed width, plus
+# index.json with the committed record count and per-session ranges.
+LANDMARK_COLUMNS = {
+    "session": (np.uint32, ()),         # index into index.json "sessions"
+    "trial": (np.uint32, ()),
+    "timestamp": (np.float32, ()),      # seconds since the session start
+    "landmarks": (np.float32, (21, 3)),
+    "direction": (np.int16, ()),        # -1 when no direction was detected
+}
+
+def landmark_archive_path():
+    return os.path.join(save_folder, "analytics", "landmarks")
+
+def _read_landmark_index(store_path):
+    index_file = os.path.join(store_path, "index.json")
+    if not os.path.exists(index_file):
+        return {"records": 0, "sessions": []}
+    with open(index_file, "r") as f:
+        return json.load(f)
+
+def append_landmark_session(store_path, session, session_start, records):
+    """
+    Append one session's records (trial, timestamp, (21, 3) landmarks,
+    direction or None) to the store. Columns are truncated back to the
+    committed record count first, so a crash mid-append never corrupts it.
+    Safe to call from several processes at once.
+    """
+    if not records:
+        return
+    os.makedirs(store_path, exist_ok=True)
+    # Stations share the store: the whole read-append-commit runs under one lock
+    with _file_lock(os.path.join(store_path, "index.lock")):
+        index = _read_landmark_index(store_path)
+        first = index["records"]
+        columns = {
+            "session": np.full(len(records), len(index["sessions"]), dtype=np.uint32),
+            "trial": np.array([r[0] for r in records], dtype=np.uint32),
+            "timestamp": np.array([r[1] - session_start for r in records], dtype=np.float32),
+            "landmarks": np.stack([r[2] for r in records]).astype(np.float32),
+            "direction": np.array([-1 if r[3] is None else r[3] for r in records], dtype=np.int16),
+        }
+        for name, (dtype, shape) in LANDMARK_COLUMNS.items():
+            record_bytes = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+            with open(os.path.join(store_path, f"{name}.bin"), "ab") as f:
+                f.truncate(first * record_bytes)
+                f.seek(first * record_bytes)
+                f.write(np.ascontiguousarray(columns[name]).tobytes())
+        index["sessions"].append({"id": session, "start": session_start, "first": first, "count": len(records)})
+        index["records"] = first + len(records)
+        fd, tmp_path = tempfile.mkstemp(dir=store_path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(store_path, "index.json"))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+    logging.info(f"Archived {len(records)} landmark frames for session {session}")
+
+def open_landmark_archive(store_path):
+    """
+    Map every column read-only (zero-copy) into NumPy. Returns (index, columns).
+    """
+    index = _read_landmark_index(store_path)
+    count = index["records"]
+    columns = {}
+    for name, (dtype, shape) in LANDMARK_COLUMNS.items():
+        if count == 0:
+            columns[name] = np.empty((0,) + shape, dtype=dtype)
+        else:
+            columns[name] = np.memmap(os.path.join(store_path, f"{name}.bin"), dtype=dtype, mode="r", shape=(count,) + shape)
+    return index, columns
+
+def classify_directions(landmarks, bin_edges=(45.0, 135.0, 225.0, 315.0)):
+    """
+    Vectorized get_finger_direction + majority vote over (N, 21, 3) landmarks.
+    bin_edges are the angle boundaries between Right/Up/Left/Down and can be
+    varied to tune the bins. Ties go to the first finger's direction, as with
+    Counter.most_common. (The face-overlap check is not applied.)
+    """
+    mcp = landmarks[:, [5, 9, 13, 17], :2]
+    tip = landmarks[:, [8, 12, 16, 20], :2]
+    delta = tip - mcp
+    angle = np.degrees(np.arctan2(-delta[..., 1], delta[..., 0])) % 360.0
+    right, up, left, down = bin_edges
+    finger_dirs = np.select(
+        [(angle >= down) | (angle < right), angle < up, angle < left],
+        [0, 90, 180], default=270,
+    ).astype(np.int16)
+    votes = (finger_dirs[:, :, None] == finger_dirs[:, None, :]).sum(axis=2)
+    best_finger = np.argmax(votes * 4 - np.arange(4), axis=1)
+    return finger_dirs[np.arange(len(finger_dirs)), best_finger]
+
+def landmark_analysis_report(store_path, bin_edges=(45.0, 135.0, 225.0, 315.0)):
+    """
+    Recompute directions for every archived frame with the given bins and
+    compare them with the recorded directions.
+    """
+    start = time.perf_counter()
+    index, columns = open_landmark_archive(store_path)
+    recomputed = classify_directions(columns["landmarks"], bin_edges)
+    stored = np.asarray(columns["direction"])
+    detected = stored >= 0
+    elapsed = time.perf_counter() - start
+    return {
+        "records": int(index["records"]),
+        "sessions": len(index["sessions"]),
+        "bin_edges": list(bin_edges),
+        "agreement": round(float((recomputed[detected] == stored[detected]).mean()), 4) if detected.any() else None,
+        "recomputed_distribution": {str(d): int((recomputed == d).sum()) for d in (0, 90, 180, 270)},
+        "elapsed_s": round(elapsed, 3),
+    }
+
+archive_landmarks = False  # set by --archive-landmarks
+session_landmarks = []  # (trial, timestamp, landmarks, direction) for the current session
+
+# ------------------------------
+# Headless Replay and Benchmarking
+# ------------------------------
+REPLAY_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+class ReplayCapture:
+    """
+    Frame source with the cv2.VideoCapture interface (read/isOpened/release)
+    that replays a recorded video file or a directory of images.
+    """
+    def __init__(self, source, loop=False):
+        self.source = source
+        self.loop = loop
+        self.frame_index = 0
+        self._video = None
+        self._images = None
+        if os.path.isdir(source):
+            self._images = sorted(
+                os.path.join(source, name) for name in os.listdir(source)
+                if name.lower().endswith(REPLAY_IMAGE_EXTENSIONS)
+            )
+        else:
+            self._video = cv2.VideoCapture(source)
+
+    def isOpened(self):
+        if self._images is not None:
+            return len(self._images) > 0
+        return self._video is not None and self._video.isOpened()
+
+    def read(self, image=None):
+        """
+        Return (ret, frame) like cv2.VideoCapture.read; if image is given and
+        has the frame's shape, the frame is copied into it and it is returned.
+        """
+        if self._images is not None:
+            if self.frame_index >= len(self._images):
+                if not self.loop or not self._images:
+                    return False, None
+                self.frame_index = 0
+            frame = cv2.imread(self._images[self.frame_index])
+            self.frame_index += 1
+            ret = frame is not None
+        elif self._video is None:
+            return False, None
+        else:
+            ret, frame = self._video.read()
+            if not ret and self.loop:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                self.frame_index = 0
+                ret, frame = self._video.read()
+            if ret:
+                self.frame_index += 1
+        if ret and image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            frame = image
+        return ret, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+        self._images = None
+
+def open_capture(source):
+    """
+    Open a camera index with its capture profile (see open_camera) or a
+    file/directory path with ReplayCapture.
+    """
+    if isinstance(source, int):
+        return open_camera(source)
+    return ReplayCapture(source, loop=True)
+
+def load_replay_labels(labels_path):
+    """
+    Load ground-truth directions from a CSV file with 'frame,direction' rows.
+    direction is 0, 90, 180, 270 or 'none'. Returns {frame_index: direction}.
+    """
+    labels = {}
+    with open(labels_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or line.lower().startswith("frame"):
+                continue
+            frame_text, direction_text = [part.strip() for part in line.split(",")[:2]]
+            labels[int(frame_text)] = None if direction_text.lower() == "none" else int(direction_text)
+    return labels
+
+def summarize_latencies(samples):
+    """
+    Return mean/p50/p95/max in milliseconds for a list of durations in seconds.
+    """
+    if not samples:
+        return {"count": 0}
+    ms = np.asarray(samples) * 1000.0
+    return {
+        "count": int(ms.size),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+def _benchmark_pass(source, max_frames, classify, stage_times):
+    """
+    Run classify(frame, stage_times) over a replay source and return the
+    per-frame directions and frame times.
+    """
+    replay = ReplayCapture(source)
+    if not replay.isOpened():
+        raise ValueError(f"Unable to open replay source: {source}")
+    directions, frame_times = [], []
+    while max_frames is None or len(directions) < max_frames:
+        ret, frame = replay.read()
+        if not ret:
+            break
+        frame_start = time.perf_counter()
+        frame = cv2.flip(frame, 1)
+        directions.append(classify(frame, stage_times))
+        frame_times.append(time.perf_counter() - frame_start)
+    replay.release()
+    return directions, frame_times
+
+def run_benchmark(source, labels_path=None, max_frames=None, gate=None):
+    """
+    Feed a recorded source through the recognition pipeline (flip + direction
+    classification, as in average_hand_direction) and report per-stage latency,
+    frames per second and direction accuracy against labels. With a MotionGate,
+    the source is also run ungated and the report compares the two. Each pass
+    starts from fresh tracking and quality state.
+    """
+    labels = load_replay_labels(labels_path) if labels_path else {}
+    stage_times = {}
+    if gate is None:
+        classify = get_extended_hand_direction
+    else:
+        gate.reset()
+        classify = lambda frame, stage_times: gate.detect(frame, stage_times)[0]
+    reset_inference_state()
+    directions, frame_times = _benchmark_pass(source, max_frames, classify, stage_times)
+    labeled = sum(1 for frame_index in labels if frame_index < len(directions))
+    correct = sum(int(directions[frame_index] == label) for frame_index, label in labels.items()
+                  if frame_index < len(directions))
 
-WHITE, BLACK = (255, 255, 255), (0, 0, 0)
+    total_time = sum(frame_times)
+    report = {
+        "source": source,
+        "frames": len(directions),
+        "fps": round(len(directions) / total_time, 2) if total_time > 0 else 0.0,
+        "frame": summarize_latencies(frame_times),
+        "stages": {stage: summarize_latencies(times) for stage, times in stage_times.items()},
+        "labeled_frames": labeled,
+        "accuracy": round(correct / labeled, 4) if labeled else None,
+        "quality": quality_controller.stats(),
+    }
+    if gate is not None:
+        reset_inference_state()
+        ungated, ungated_times = _benchmark_pass(source, max_frames, get_extended_hand_direction, {})
+        ungated_total = sum(ungated_times)
+        agreeing = sum(int(a == b) for a, b in zip(directions, ungated))
+        report["motion_gate"] = dict(
+            gate.stats(),
+            ungated_fps=round(len(ungated) / ungated_total, 2) if ungated_total > 0 else 0.0,
+            agreement=round(agreeing / len(ungated), 4) if ungated else None,
+            disagreeing_frames=[i for i, (a, b) in enumerate(zip(directions, ungated)) if a != b],
+        )
+    return report
 
-clinical_levels = [
-    {"snellen": "10/200"},
-    {"snellen": "10/160"},
-    {"snellen": "10/125"},
-    {"snellen": "10/100"},
-    {"snellen": "10/80"},
-    {"snellen": "10/70"},
-    {"snellen": "10/60"},
-    {"snellen": "10/50"},
-    {"snellen": "10/40"},
-    {"snellen": "10/30"},
-    {"snellen": "10/25"},
-    {"snellen": "10/20"},
-    {"snellen": "10/15"},
-    {"snellen": "10/10"},
-]
-test_distance = 1  # Standard test distance in meters
+# ------------------------------
+# Shared Inference Server
+# ------------------------------
+INFERENCE_MAX_SIDE = 720  # frames are square-cropped and downscaled to fit a slot
 
+def landmarks_to_array(hand_landmarks):
+    """
+    Convert MediaPipe hand landmarks to a (21, 3) float32 array of x, y, z.
+    """
+    return np.array([(lm.x, lm.y, lm.z) for lm in hand_landmarks.landmark], dtype=np.float32)
 
-mp_hands = mp.solutions.hands
-hands_detector = mp_hands.Hands(
-    static_image_mode=False,
-    max_num_hands=1,
-    model_complexity=1,
-    min_detection_confidence=0.7,
-    min_tracking_confidence=0.5
-)
-cap = None  # Will be initialized after camera selection
-mp_face_detection = mp.solutions.face_detection
-face_detection = mp_face_detection.FaceDetection(min_detection_confidence=0.7)
+def _inference_worker(slot_names, requests, responses, stats, max_batch, batch_window_s):
+    """
+    Inference process: attaches to every client slot and answers requests with
+    this process's own MediaPipe graphs. Pending requests are drained in
+    micro-batches of up to max_batch to amortize queue wake-ups. Each client
+    always goes to the same worker and gets its own hand graph there, so the
+    graph's tracking state only ever sees that client's camera, exactly as
+    on the per-station path.
+    """
+    global hands_detector
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    client_detectors = {}
+    frame_rgb = None
+    running = True
+    while running:
+        batch = [requests.get()]
+        deadline = time.perf_counter() + batch_window_s
+        while len(batch) < max_batch and batch[-1] is not None:
+            try:
+                batch.append(requests.get(timeout=max(0.0, deadline - time.perf_counter())))
+            except queue.Empty:
+                break
+        if batch[-1] is None:
+            batch.pop()
+            running = False
+        for client_id, side, submitted in batch:
+            # Zero-copy view of the frame the client wrote into its slot
+            frame_rgb = np.ndarray((side, side, 3), dtype=np.uint8, buffer=slots[client_id].buf)
+            if client_id not in client_detectors:
+                client_detectors[client_id] = build_hands_detector()
+            hands_detector = client_detectors[client_id]
+            direction, hand_landmarks = classify_hand_rgb(frame_rgb)
+            landmarks = landmarks_to_array(hand_landmarks) if hand_landmarks is not None else None
+            responses[client_id].put((direction, landmarks))
+            with stats.get_lock():
+                stats[0] += 1
+                stats[2] += time.time() - submitted
+        if batch:
+            with stats.get_lock():
+                stats[1] += 1
+    frame_rgb = None  # release the last view before closing the slots
+    for slot in slots:
+        slot.close()
+    for detector in client_detectors.values():
+        detector.close()
 
-calibrated_camera_matrix = None
-calibrated_dist_coeffs = None
+class InferenceClient:
+    """
+    Station-side handle to the inference server. Owns one shared-memory slot:
+    the frame is cropped and color-converted straight into it, then only the
+    slot id travels over the request queue.
+    """
+    def __init__(self, client_id, slot, requests, responses):
+        self.client_id = client_id
+        self.slot = slot
+        self.requests = requests
+        self.responses = responses
 
-user_name = user_surname = user_age = ""
-national_id = ""
-phone = ""
-email = ""
-photo_path = None
-left_eye_correct, left_eye_incorrect = [], []
-right_eye_correct, right_eye_incorrect = [], []
-gemini_recommendation = "No recommendation."
+    def get_direction(self, frame):
+        """
+        Return (direction or None, (21, 3) landmarks array or None) for a BGR frame.
+        """
+        square = crop_to_square(frame)
+        side = square.shape[0]
+        if side > INFERENCE_MAX_SIDE:
+            square = cv2.resize(square, (INFERENCE_MAX_SIDE, INFERENCE_MAX_SIDE), interpolation=cv2.INTER_AREA)
+            side = INFERENCE_MAX_SIDE
+        target = np.ndarray((side, side, 3), dtype=np.uint8, buffer=self.slot.buf)
+        cv2.cvtColor(square, cv2.COLOR_BGR2RGB, dst=target)
+        del target
+        self.requests.put((self.client_id, side, time.time()))
+        return self.responses.get()
 
-def crop_to_square(frame):
-    h, w, _ = frame.shape
-    side = min(w, h)
-    start_x = (w - side) // 2
-    start_y = (h - side) // 2
-    return frame[start_y:start_y+side, start_x:start_x+side]
+class InferenceServer:
+    """
+    Pool of inference processes, each with its own loaded MediaPipe graphs,
+    shared by several stations. Frames are handed over through one
+    preallocated shared-memory slot per client. Client i is served by worker
+    i % num_workers through that worker's request queue.
+    """
+    def __init__(self, num_workers, num_clients, max_batch=4, batch_window_ms=2.0):
+        self._ctx = multiprocessing.get_context("spawn")
+        slot_bytes = INFERENCE_MAX_SIDE * INFERENCE_MAX_SIDE * 3
+        self.slots = [shared_memory.SharedMemory(create=True, size=slot_bytes) for _ in range(num_clients)]
+        self.requests = [self._ctx.Queue() for _ in range(num_workers)]
+        self.responses = [self._ctx.Queue() for _ in range(num_clients)]
+        # requests served, batches, summed request latency (s)
+        self.stats = self._ctx.Array("d", 3)
+        self.start_time = time.perf_counter()
+        self.workers = []
+        # Workers import this module; they never need a real display
+        with _patched_environ({"SDL_VIDEODRIVER": "dummy"}):
+            for i in range(num_workers):
+                worker = self._ctx.Process(
+                    target=_inference_worker,
+                    args=([slot.name for slot in self.slots], self.requests[i], self.responses,
+                          self.stats, max_batch, batch_window_ms / 1000.0),
+                    name=f"inference-{i}", daemon=True,
+                )
+                worker.start()
+                self.workers.append(worker)
+        logging.info(f"Inference server started with {num_workers} worker(s) for {num_clients} client(s)")
 
-def get_finger_direction(landmarks, mcp_index, tip_index):
-    mcp = landmarks.landmark[mcp_index]
-    tip = landmarks.landmark[tip_index]
-    dx, dy = tip.x - mcp.x, tip.y - mcp.y
-    angle = math.degrees(math.atan2(-dy, dx))
-    angle = angle if angle >= 0 else angle + 360
-    if angle >= 315 or angle < 45:
-        return 0
-    elif 45 <= angle < 135:
-        return 90
-    elif 135 <= angle < 225:
-        return 180
-    else:
-        return 270
+    def client(self, client_id):
+        return InferenceClient(client_id, self.slots[client_id], self.requests[client_id % len(self.requests)],
+                               self.responses[client_id])
 
-def get_extended_hand_direction(frame):
-    square_frame = crop_to_square(frame)
-    frame_rgb = cv2.cvtColor(square_frame, cv2.COLOR_BGR2RGB)
-    results = hands_detector.process(frame_rgb)
-    if results.multi_hand_landmarks:
-        hand_landmarks = results.multi_hand_landmarks[0]
-        h, w, _ = square_frame.shape
-        xs = [lm.x for lm in hand_landmarks.landmark]
-        ys = [lm.y for lm in hand_landmarks.landmark]
-        hand_center_x = sum(xs) / len(xs) * w
-        hand_center_y = sum(ys) / len(ys) * h
+    def metrics(self):
+        with self.stats.get_lock():
+            served, batches, latency_sum = self.stats[:]
+        elapsed = time.perf_counter() - self.start_time
+        try:
+            queue_depth = sum(requests.qsize() for requests in self.requests)
+        except NotImplementedError:  # not available on macOS
+            queue_depth = None
+        return {
+            "requests": int(served),
+            "batches": int(batches),
+            "mean_batch_size": round(served / batches, 2) if batches else 0.0,
+            "mean_latency_ms": round(latency_sum / served * 1000.0, 3) if served else 0.0,
+            "throughput_fps": round(served / elapsed, 2) if elapsed > 0 else 0.0,
+            "queue_depth": queue_depth,
+        }
 
-        face_results = face_detection.process(frame_rgb)
-        if face_results.detections:
-            detection = face_results.detections[0]
-            bbox = detection.location_data.relative_bounding_box
-            face_x = bbox.xmin * w
-            face_y = bbox.ymin * h
-            face_width = bbox.width * w
-            face_height = bbox.height * h
-            if face_x <= hand_center_x <= face_x + face_width and face_y <= hand_center_y <= face_y + face_height:
-                return None
+    def shutdown(self):
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        logging.info(f"Inference server stopped: {self.metrics()}")
 
-        directions = []
-        for mcp, tip in [(5, 8), (9, 12), (13, 16), (17, 20)]:
-            directions.append(get_finger_direction(hand_landmarks, mcp, tip))
-        return Counter(directions).most_common(1)[0][0]
-    return None
+def check_inference_server(source, max_frames=None, num_workers=1):
+    """
+    Run a recording through the local path and through an InferenceServer
+    client and report how often their per-frame directions agree. Both passes
+    start from fresh graphs at full quality with adaptation off. Crops larger
+    than INFERENCE_MAX_SIDE are downscaled on the server path only.
+    """
+    reset_inference_state(adaptive=False)
+    local, local_times = _benchmark_pass(source, max_frames, get_extended_hand_direction, {})
+    server = InferenceServer(num_workers, 1)
+    try:
+        client = server.client(0)
+        served, served_times = _benchmark_pass(
+            source, max_frames, lambda frame, stage_times: client.get_direction(frame)[0], {})
+        metrics = server.metrics()
+    finally:
+        server.shutdown()
+        reset_inference_state()
+    agreeing = sum(int(a == b) for a, b in zip(local, served))
+    return {
+        "frames": len(served),
+        "agreement": round(agreeing / len(served), 4) if served else None,
+        "disagreeing_frames": [i for i, (a, b) in enumerate(zip(local, served)) if a != b],
+        "local_fps": round(len(local) / sum(local_times), 2) if sum(local_times) > 0 else 0.0,
+        "server_fps": round(len(served) / sum(served_times), 2) if sum(served_times) > 0 else 0.0,
+        "server": metrics,
+    }
 
-def average_hand_direction(duration=0.5):
-    samples = []
-    start_time = time.time()
-    while time.time() - start_time < duration:
-        ret, frame = cap.read()
-        if not ret:
-            continue
-        frame = cv2.flip(frame, 1)
-        direction = get_extended_hand_direction(frame)
-        if direction is not None:
-            samples.append(direction)
-        time.sleep(0.05)
-    return Counter(samples).most_common(1)[0][0] if samples else None
+inference_client = None  # set in station processes that use the shared server
 
 def render_letter(letter_surface):
     rect = letter_surface.get_rect(center=(screen_width // 2, screen_height // 2))
@@ -630,6 +2914,10 @@ def render_letter(letter_surface):
     return letter_surface, rect
 
 def detect_distance():
+    with perf_metrics.span("distance_detection"):
+        return _detect_distance()
+
+def _detect_distance():
     ret, frame = cap.read()
     if not ret:
         logging.error("Unable to read frame from camera.")
@@ -642,18 +2930,7 @@ def detect_distance():
         h, w, _ = frame.shape
         face_width = bbox.width * w
         REAL_FACE_WIDTH = 0.16  # Real face width in meters
-        focals_file = os.path.join(BASE_DIR, "camera_focals.json")
-        if os.path.exists(focals_file):
-            try:
-                with open(focals_file, "r") as f:
-                    focals_data = json.load(f)
-                focal_length = next(iter(focals_data.values()), 700)
-                logging.info(f"Loaded saved focal length: {focal_length}")
-            except Exception as e:
-                logging.error(f"Error reading focals file: {e}")
-                focal_length = 700
-        else:
-            focal_length = 700
+        focal_length = next(iter(settings_store.get("camera_focals").values()), 700)
         if face_width <= 1e-6:
             logging.error("Detected face width too small; using default distance.")
             return test_distance
@@ -665,24 +2942,181 @@ def detect_distance():
 
 def adjust_font_sizes(measured_distance):
     """
-    Scale font_size_px for each level from the stored 'baseline_px' according to measured_distance.
+    Scale 'level_font_px' from 'level_baseline_px' according to measured_distance.
     This preserves relative differences between levels.
     """
+    global level_font_px
     if measured_distance <= 0:
         logging.error("Measured distance invalid; skipping font size adjustment.")
         return
+    if level_baseline_px is None:
+        logging.error("Baseline font sizes not computed; skipping font size adjustment.")
+        return
+
+    level_font_px = scaled_font_sizes_px(measured_distance)
+    logging.info(f"Scale factor: {measured_distance / test_distance:.2f}, font sizes: {level_font_px.tolist()}")
+
+def scaled_font_sizes_px(distance_m):
+    """
+    Scale the baseline sizes to one or more distances (vectorized, minimum 5px).
+    """
+    scale = np.asarray(distance_m, dtype=np.float64)[..., np.newaxis] / test_distance
+    baseline = np.maximum(level_baseline_px, 1)
+    return np.maximum(np.rint(baseline * scale), 5).astype(np.int32)
+
+# ------------------------------
+# Trial Latency Analytics
+# ------------------------------
+def trial_log_path():
+    return os.path.join(save_folder, "analytics", "trials.jsonl")
+
+def save_trial_log(trials):
+    """
+    Append the session's trial records to the shared analytics log (no patient
+    identifiers are written, only the session id).
+    """
+    if not trials:
+        return
+    path = trial_log_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            for trial in trials:
+                f.write(json.dumps(trial) + "\n")
+        logging.info(f"Saved {len(trials)} trial records to {path}")
+    except Exception as e:
+        logging.error(f"Error saving trial log: {e}")
 
-    scale = measured_distance / test_distance
-    logging.info(f"Scale factor: {scale:.2f}")
+def load_trial_log(path):
+    trials = []
+    if not os.path.exists(path):
+        logging.error(f"Trial log not found: {path}")
+        return trials
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    trials.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logging.warning("Skipping malformed trial record")
+    return trials
+
+def _percentiles(values):
+    arr = np.asarray(values, dtype=np.float64)
+    if arr.size == 0:
+        return {"count": 0}
+    p50, p90, p99 = np.percentile(arr, [50, 90, 99])
+    return {"count": int(arr.size), "mean": round(float(arr.mean()), 4), "p50": round(float(p50), 4),
+            "p90": round(float(p90), 4), "p99": round(float(p99), 4), "max": round(float(arr.max()), 4)}
 
+def trial_analytics_report(trials, slowest=5):
+    """
+    Aggregate trial records across sessions: overall and per-level percentiles
+    of trial duration, samples and stability resets, plus the slowest levels.
+    """
+    hand_trials = [t for t in trials if t.get("input") == "hand"]
+    per_level = {}
     for level in clinical_levels:
-        baseline = level.get("baseline_px", level.get("font_size_px", 8))
-        # Ensure baseline is at least 1
-        baseline = max(1, int(baseline))
-        new_px = max(int(round(baseline * scale)), 5)  # enforce a minimum visible size
-        level["font_size_px"] = new_px
-        logging.info(f"Level {level['snellen']} adjusted from baseline {baseline}px to {new_px}px")
+        level_trials = [t for t in hand_trials if t.get("level") == level["snellen"]]
+        if not level_trials:
+            continue
+        per_level[level["snellen"]] = {
+            "duration_s": _percentiles([t["duration_s"] for t in level_trials]),
+            "samples": _percentiles([t["samples"] for t in level_trials]),
+            "resets": _percentiles([t["resets"] for t in level_trials]),
+            "reset_rate": round(sum(1 for t in level_trials if t["resets"]) / len(level_trials), 4),
+            "accuracy": round(sum(1 for t in level_trials if t["correct"]) / len(level_trials), 4),
+        }
+    slowest_levels = sorted(per_level, key=lambda lvl: per_level[lvl]["duration_s"]["p90"], reverse=True)[:slowest]
+    return {
+        "sessions": len({t.get("session_id") for t in trials}),
+        "trials": len(trials),
+        "keyboard_trials": len(trials) - len(hand_trials),
+        "duration_s": _percentiles([t["duration_s"] for t in hand_trials]),
+        "windows": _percentiles([t["windows"] for t in hand_trials]),
+        "samples": _percentiles([t["samples"] for t in hand_trials]),
+        "resets": _percentiles([t["resets"] for t in hand_trials]),
+        "per_level": per_level,
+        "slowest_levels": [{"level": lvl, "p90_duration_s": per_level[lvl]["duration_s"]["p90"]} for lvl in slowest_levels],
+    }
+
+# ------------------------------
+# Non-blocking UI Pauses
+# ------------------------------
+PAUSE_SKIP_KEYS = (pygame.K_SPACE, pygame.K_RETURN)
+
+class BackgroundJob:
+    """
+    Run fn(*args) in a daemon thread so it can overlap a UI pause. An
+    exception raised by fn is logged and re-raised by result().
+    """
+    def __init__(self, fn, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(fn, args), daemon=True)
+        self._thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception as e:
+            logging.error(f"Background job {getattr(fn, '__name__', fn)} failed: {e}")
+            self._error = e
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+def ui_pause(name, on_tick=None, until=None):
+    """
+    Non-blocking replacement for pygame.time.wait. Keeps the event loop running
+    for the pause named in PAUSE_DURATIONS_MS; a click or Space/Enter skips it.
+    on_tick is called every frame so capture or other work can overlap the
+    pause, and if until is given the pause also lasts until until() is True.
+    """
+    duration_s = PAUSE_DURATIONS_MS.get(name, 0) / 1000.0
+    clock = pygame.time.Clock()
+    start = time.perf_counter()
+    skipped = False
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                if cap is not None:
+                    cap.release()
+                exit()
+            elif (event.type == pygame.KEYDOWN and event.key in PAUSE_SKIP_KEYS) or event.type == pygame.MOUSEBUTTONDOWN:
+                skipped = True
+        if on_tick:
+            on_tick()
+        if (skipped or time.perf_counter() - start >= duration_s) and (until is None or until()):
+            break
+        clock.tick(60)
+    if skipped:
+        logging.info(f"Pause '{name}' skipped after {time.perf_counter() - start:.2f}s")
+
+def drain_capture():
+    """
+    Grab (without decoding) a frame so the camera buffer stays fresh during pauses.
+    """
+    if cap is not None:
+        cap.grab()
 
+def warm_up_inference():
+    """
+    Run the hand and face graphs once on a blank frame so the first real trial
+    does not pay the model initialization cost.
+    """
+    blank = np.zeros((256, 256, 3), dtype=np.uint8)
+    hands_detector.process(blank)
+    face_detection.process(blank)
+    logging.info("MediaPipe graphs warmed up.")
 
 def display_logo():
     # Modern, minimal, and fresh game-like splash with gradients and glassmorphism
@@ -731,7 +3165,8 @@ def display_logo():
     screen.blit(sub_text, sub_text.get_rect(center=(screen_width//2, screen_height//2 + 110)))
 
     pygame.display.flip()
-    pygame.time.wait(2000)
+    warm_up_job = BackgroundJob(warm_up_inference)
+    ui_pause("logo", until=warm_up_job.done)
 
 def show_instructions():
     # Use a blue panel for instructions
@@ -749,22 +3184,195 @@ def show_instructions():
     for i, line in enumerate(instructions):
         screen.blit(font.render(line, True, (0, 51, 102)), (panel_rect.left + 30, panel_rect.top + 30 + i * 45))
     pygame.display.flip()
-    pygame.time.wait(3000)
+    ui_pause("instructions")
+
+# ------------------------------
+# Patient Lookup Index
+# ------------------------------
+def normalize_patient_field(field, value):
+    value = (value or "").strip()
+    if field == "phone":
+        return "".join(ch for ch in value if ch.isdigit())
+    if field == "national_id":
+        return "".join(ch for ch in value if ch.isalnum()).upper()
+    if field == "email":
+        return value.lower()
+    # Names: lowercase, strip accents, collapse whitespace
+    if not value.isascii():
+        value = unicodedata.normalize("NFKD", value)
+        value = "".join(ch for ch in value if not unicodedata.combining(ch))
+    return " ".join(value.lower().split())
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PatientIndex:
+    """
+    In-memory patient index persisted as an append-only JSON-lines file.
+    Every searchable field has a sorted (value, folder) list for O(log n)
+    prefix lookup; names also have a trigram index for fuzzy matches.
+    Records are keyed by patient folder name.
+    """
+    FIELDS = ("national_id", "phone", "email", "name", "surname")
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._sorted = {field: [] for field in self.FIELDS}
+        self._trigrams = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def _keys(self, record):
+        full_name = f"{record.get('name', '')} {record.get('surname', '')}"
+        reversed_name = f"{record.get('surname', '')} {record.get('name', '')}"
+        return {
+            "national_id": normalize_patient_field("national_id", record.get("national_id")),
+            "phone": normalize_patient_field("phone", record.get("phone")),
+            "email": normalize_patient_field("email", record.get("email")),
+            "name": normalize_patient_field("name", full_name),
+            "surname": normalize_patient_field("name", reversed_name),
+        }
+
+    def _unindex(self, folder):
+        record = self.records.pop(folder, None)
+        if record is None:
+            return
+        keys = self._keys(record)
+        for field, value in keys.items():
+            entries = self._sorted[field]
+            i = bisect.bisect_left(entries, (value, folder))
+            if i < len(entries) and entries[i] == (value, folder):
+                del entries[i]
+        for gram in _trigrams(keys["name"]):
+            self._trigrams[gram].discard(folder)
+
+    def _index(self, record, bulk=False):
+        folder = record["folder"]
+        if not bulk:
+            self._unindex(folder)
+        self.records[folder] = record
+        keys = self._keys(record)
+        for field, value in keys.items():
+            if value:
+                if bulk:
+                    self._sorted[field].append((value, folder))
+                else:
+                    bisect.insort(self._sorted[field], (value, folder))
+        for gram in _trigrams(keys["name"]):
+            self._trigrams[gram].add(folder)
+
+    def load(self, results_folder):
+        """
+        Load the index file, or build it from existing patient folders the
+        first time. Safe to run in a background thread.
+        """
+        records = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        records[record["folder"]] = record
+                    except (json.JSONDecodeError, KeyError):
+                        continue
+        elif os.path.isdir(results_folder):
+            for entry in os.scandir(results_folder):
+                if entry.is_dir() and "_" in entry.name:
+                    name, surname = entry.name.split("_", 1)
+                    records[entry.name] = {"folder": entry.name, "name": name, "surname": surname}
+            for record in records.values():
+                self._append(record)
+        with self._lock:
+            for record in records.values():
+                self._index(record, bulk=True)
+            for entries in self._sorted.values():
+                entries.sort()
+        logging.info(f"Patient index loaded: {len(self.records)} patients")
+
+    def _append(self, record):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            logging.error(f"Error updating patient index: {e}")
+
+    def add(self, record):
+        with self._lock:
+            self._index(record)
+        self._append(record)
+
+    def lookup(self, field, text, limit=5):
+        """
+        Return up to limit records whose field starts with text; for names,
+        fuzzy trigram matches fill the remaining places.
+        """
+        query = normalize_patient_field("name" if field == "surname" else field, text)
+        if not query:
+            return []
+        with self._lock:
+            entries = self._sorted[field]
+            matches = []
+            i = bisect.bisect_left(entries, (query, ""))
+            while i < len(entries) and entries[i][0].startswith(query) and len(matches) < limit:
+                if entries[i][1] not in matches:
+                    matches.append(entries[i][1])
+                i += 1
+            if field in ("name", "surname") and len(matches) < limit and len(query) >= 3:
+                counts = Counter()
+                for gram in _trigrams(query):
+                    counts.update(self._trigrams.get(gram, ()))
+                candidates = [folder for folder, _ in counts.most_common(50) if folder not in matches]
+                ranked = sorted(
+                    candidates,
+                    key=lambda folder: difflib.SequenceMatcher(None, query, self._keys(self.records[folder])[field]).ratio(),
+                    reverse=True,
+                )
+                matches.extend(ranked[:limit - len(matches)])
+            return [self.records[folder] for folder in matches]
+
+def patient_label(record):
+    details = [record.get(field) for field in ("national_id", "phone") if record.get(field)]
+    return " - ".join([f"{record.get('name', '')} {record.get('surname', '')}"] + details)
+
+def load_patient_history(user_folder):
+    """
+    Read a patient's previous reports and stored result counts (used to
+    prefetch history in the background once a patient is selected).
+    """
+    history = {"reports": [], "previous_results": None}
+    if not os.path.isdir(user_folder):
+        return history
+    history["reports"] = sorted(f for f in os.listdir(user_folder) if f.endswith('.pdf'))
+    results_file = os.path.join(user_folder, "previous_results.txt")
+    if os.path.exists(results_file):
+        try:
+            with open(results_file, "r") as f:
+                history["previous_results"] = [int(line.strip()) for line in f.readlines()[:4]]
+        except Exception as e:
+            logging.error(f"Error reading previous results: {e}")
+    return history
+
+patient_index = PatientIndex(os.path.join(save_folder, "patients.jsonl"))
 
-def compare_with_previous_results(user_folder):
+def compare_with_previous_results(user_folder, history=None):
     logging.info(f"Comparing current results with previous tests in folder: {user_folder}")
-    previous_files = [f for f in os.listdir(user_folder) if f.endswith('.pdf')]
+    if history is None:
+        history = load_patient_history(user_folder)
+    previous_files = history["reports"]
     if previous_files:
         logging.info(f"Found {len(previous_files)} previous test file(s).")
     else:
         logging.info("No previous tests found.")
+    return history
 
 def show_form(manager):
     # Draw a semi-transparent white panel for the form
     panel_surface = pygame.Surface((600, 480), pygame.SRCALPHA)
     panel_surface.fill((255, 255, 255, 220))  # semi-transparent white
     panel_rect = panel_surface.get_rect(center=(screen_width // 2, screen_height // 2 + 20))
-    screen.blit(background_form, (0, 0))
+    screen.blit(ui_assets.get("background"), (0, 0))
     screen.blit(panel_surface, panel_rect)
 
     # Draw a blue medical header with a stethoscope icon (if available)
@@ -796,6 +3404,8 @@ def show_form(manager):
     submit_button = UIButton(pygame.Rect((base_x, base_y + 7 * spacing), (panel_rect.width - 80, 36)), 'Submit', manager)
     start_test_button = UIButton(pygame.Rect((base_x, base_y + 8 * spacing), (panel_rect.width - 80, 36)), 'Start Integrated Vision Test', manager)
     start_test_button.visible = False
+    # Returning-patient suggestions, filled as the operator types
+    suggestion_list = UISelectionList(pygame.Rect((panel_rect.right + 10, base_y), (320, 200)), [], manager)
 
     pygame.display.flip()
 
@@ -808,27 +3418,32 @@ def show_form(manager):
         "email_entry": email_entry,
         "photo_button": photo_button,
         "submit_button": submit_button,
-        "start_test_button": start_test_button
+        "start_test_button": start_test_button,
+        "suggestion_list": suggestion_list
     }
 
 def save_results(user_name, user_surname, user_age, national_id, phone, email,
                  left_correct, left_incorrect, right_correct, right_eye_incorrect,
-                 recommendation, photo_path=None):
+                 recommendation, photo_path=None, chart_path=None, history=None, findings=None):
     # Updated to use save_folder for saving results
     folder_name = os.path.join(save_folder, f"{user_name}_{user_surname}")
     os.makedirs(folder_name, exist_ok=True)
 
     # Use the correct parameter name for right eye incorrect levels
-    comparison_text = generate_comparison_text(folder_name, left_correct, left_incorrect, right_correct, right_eye_incorrect)  # type: ignore
+    comparison_text = generate_comparison_text(folder_name, left_correct, left_incorrect, right_correct, right_eye_incorrect,  # type: ignore
+                                               history["previous_results"] if history else None)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     pdf_filename = os.path.join(folder_name, f"vision_test_{timestamp}.pdf")
     try:
         doc = SimpleDocTemplate(pdf_filename, pagesize=letter)
         styles = getSampleStyleSheet()
 
-        # recommendation
+        # recommendation: the local analysis is coloured from its findings (its
+        # headings always mention "risk"); free text from Gemini by its wording
         rec_lower = recommendation.lower()
-        if "risk" in rec_lower or "abnormal" in rec_lower:
+        if findings is not None:
+            color = "red" if findings["referral"] else "green"
+        elif "risk" in rec_lower or "abnormal" in rec_lower:
             color = "red"
         elif "no significant" in rec_lower:
             color = "green"
@@ -859,34 +3474,70 @@ def save_results(user_name, user_surname, user_age, national_id, phone, email,
 
         # Add comparison text (it's a textual summary, not a file path)
         elements.append(Paragraph(comparison_text.replace("\n", "<br/>"), styles['Normal']))
-        # If a photo exists, attach it
-        if photo_path and os.path.exists(photo_path):
+        if chart_path:
+            try:
+                elements.append(Paragraph("Visual acuity trend:", styles['Normal']))
+                elements.append(Image(chart_path, width=6*inch, height=3*inch))
+            except Exception as e:
+                logging.error(f"Error adding acuity chart to PDF: {e}")
+        # If a photo exists, attach its report-sized thumbnail
+        thumb_path = ingest_photo(photo_path, folder_name)
+        if thumb_path:
             try:
-                elements.append(Image(photo_path, width=2*inch, height=2*inch))
+                elements.append(Image(thumb_path, width=REPORT_PHOTO_INCHES*inch, height=REPORT_PHOTO_INCHES*inch))
             except Exception as e:
                 logging.error(f"Error adding photo to PDF: {e}")
-        doc.build(elements)
+        with perf_metrics.span("pdf_build"):
+            doc.build(elements)
         logging.info("Results saved successfully as PDF.")
     except Exception as e:
         logging.error(f"Error saving results as PDF: {e}")
 
     upload_to_cloud(folder_name, pdf_filename)
 
-def wait_for_stable_hand(manager, stable_time=1.5, current_image=None):
+def new_trial_stats():
+    return {"windows": 0, "frames": 0, "samples": 0, "resets": 0, "input": "hand"}
+
+STATUS_STRIP_HEIGHT = 100
+_status_surface_cache = {}
+
+def get_status_surface(status):
+    """
+    Return the cached status-strip text surface for a direction (0/90/180/270)
+    or "warning". Surfaces are cached per screen size since the font scales with it.
+    """
+    key = (status, screen_width, screen_height)
+    surface = _status_surface_cache.get(key)
+    if surface is None:
+        warning_font = get_scaled_font(30)
+        if status == "warning":
+            surface = warning_font.render("No hand, voice, or keyboard input detected!", True, (255, 0, 0))
+        else:
+            direction_text = DIRECTION_NAMES.get(status, str(status))
+            surface = warning_font.render(f"Hand detected: {direction_text}", True, (0, 255, 0))
+        _status_surface_cache[key] = surface
+    return surface
+
+def wait_for_stable_hand(manager, stable_time=1.5, current_image=None, trial_stats=None):
+    """
+    Wait until the hand direction is stable for stable_time seconds (or an arrow
+    key is pressed) and return it. If trial_stats (see new_trial_stats) is given,
+    capture windows, frames, samples, stability resets and input type are recorded.
+    Only the status strip is redrawn when its text changes; the stimulus is
+    redrawn on the first pass and after a resize/expose.
+    """
     stable_direction, start_stable = None, None
     start_time = time.time()
-    warning_font = get_scaled_font(30)
-
-    # Mapping English directions
-    direction_mapping = {
-        0: "Right",
-        90: "Up",
-        180: "Left",
-        270: "Down"
-    }
+    status_rect = pygame.Rect(0, screen_height - STATUS_STRIP_HEIGHT, screen_width, STATUS_STRIP_HEIGHT)
+    img_rect = current_image.get_rect(center=(screen_width // 2, screen_height // 2)) if current_image else None
+    shown_status = None
+    redraw_stimulus = True
+    motion_gate.reset()
 
     while True:
-        direction = average_hand_direction(duration=0.5)
+        direction = average_hand_direction(duration=0.5, trial_stats=trial_stats)
+        if trial_stats is not None:
+            trial_stats["windows"] += 1
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 pygame.quit()
@@ -894,32 +3545,44 @@ def wait_for_stable_hand(manager, stable_time=1.5, current_image=None):
                 exit()
             elif event.type == pygame.KEYDOWN:
                 # Return immediately on key press
-                if event.key == pygame.K_UP:
-                    return 90
-                elif event.key == pygame.K_RIGHT:
-                    return 0
-                elif event.key == pygame.K_DOWN:
-                    return 270
-                elif event.key == pygame.K_LEFT:
-                    return 180
+                key_direction = KEY_DIRECTIONS.get(event.key)
+                if key_direction is not None:
+                    if trial_stats is not None:
+                        trial_stats["input"] = "keyboard"
+                    return key_direction
+            elif event.type in (pygame.VIDEORESIZE, pygame.VIDEOEXPOSE, pygame.WINDOWSIZECHANGED):
+                redraw_stimulus = True
             manager.process_events(event)
+
+        status = None
         if direction is None and time.time() - start_time > 10:
-            pygame.draw.rect(screen, WHITE, (0, screen_height - 100, screen_width, 100))
-            screen.blit(warning_font.render("No hand, voice, or keyboard input detected!", True, (255, 0, 0)), (100, screen_height - 80))
+            status = "warning"
         elif direction is not None:
-            pygame.draw.rect(screen, WHITE, (0, screen_height - 100, screen_width, 100))
-            direction_text = direction_mapping.get(direction, str(direction))
-            screen.blit(warning_font.render(f"Hand detected: {direction_text}", True, (0, 255, 0)), (100, screen_height - 80))
+            status = direction
             if stable_direction != direction:
+                if stable_direction is not None and trial_stats is not None:
+                    trial_stats["resets"] += 1
                 stable_direction, start_stable = direction, time.time()
             elif time.time() - start_stable >= stable_time:
                 return direction
-        if current_image:
-            img_rect = current_image.get_rect(center=(screen_width // 2, screen_height // 2))
+
+        dirty_rects = []
+        if status is not None and status != shown_status:
+            pygame.draw.rect(screen, WHITE, status_rect)
+            screen.blit(get_status_surface(status), (100, screen_height - 80))
+            # Restore the part of the stimulus the strip covers
+            overlap = img_rect.clip(status_rect) if img_rect else None
+            if overlap:
+                screen.blit(current_image, overlap.topleft, area=overlap.move(-img_rect.x, -img_rect.y))
+            dirty_rects.append(status_rect)
+            shown_status = status
+        if redraw_stimulus and img_rect:
             screen.blit(current_image, img_rect)
+            dirty_rects.append(img_rect)
+        redraw_stimulus = False
         manager.update(0.01)
-        manager.draw_ui(screen)
-        pygame.display.update()
+        if dirty_rects:
+            pygame.display.update(dirty_rects)
 
 def perform_full_test_for_eye(eye, manager, measured_distance):
     prompt_font = get_scaled_font(30)
@@ -927,55 +3590,71 @@ def perform_full_test_for_eye(eye, manager, measured_distance):
     prompt_text = f"Please cover your {eye} eye for the test"
     screen.blit(prompt_font.render(prompt_text, True, BLACK), (200, 250))
     pygame.display.flip()
-    pygame.time.wait(3000)
+    ui_pause("cover_eye", on_tick=drain_capture)
 
     correct_levels, incorrect_levels = [], []
-    for level_data in clinical_levels:
-        font_size = level_data["font_size_px"]          
+    for level_index, level_data in enumerate(clinical_levels):
+        font_size = int(level_font_px[level_index])
         snellen_ratio = level_data["snellen"]
         expected_direction = random.choice([0, 90, 180, 270])
-        # Change to use Optotype font
-        font = get_optotype_font(font_size)
-        letter_surface = font.render("E", True, BLACK)
-        letter_surface, rect = render_letter(letter_surface)
-        rotated_surface = pygame.transform.rotate(letter_surface, expected_direction)
-
-        screen.fill(WHITE)
-        screen.blit(prompt_font.render(f"Level: {snellen_ratio}", True, BLACK), (10, 10))
-        screen.blit(prompt_font.render(f"Adjusted to distance: {measured_distance:.2f} m", True, BLACK), (10, 40))
-        rect = rotated_surface.get_rect(center=(screen_width // 2, screen_height // 2))
-        screen.blit(rotated_surface, rect)
-        manager.update(0.01)
-        manager.draw_ui(screen)
-        pygame.display.flip()
+        with perf_metrics.span("optotype_render"):
+            # Change to use Optotype font
+            font = get_optotype_font(font_size)
+            letter_surface = font.render("E", True, BLACK)
+            letter_surface, rect = render_letter(letter_surface)
+            rotated_surface = pygame.transform.rotate(letter_surface, expected_direction)
+
+            screen.fill(WHITE)
+            screen.blit(prompt_font.render(f"Level: {snellen_ratio}", True, BLACK), (10, 10))
+            screen.blit(prompt_font.render(f"Adjusted to distance: {measured_distance:.2f} m", True, BLACK), (10, 40))
+            rect = rotated_surface.get_rect(center=(screen_width // 2, screen_height // 2))
+            screen.blit(rotated_surface, rect)
+            manager.update(0.01)
+            manager.draw_ui(screen)
+            pygame.display.flip()
 
-        stable_dir = wait_for_stable_hand(manager, stable_time=1.5, current_image=rotated_surface)
+        trial_stats = new_trial_stats()
+        trial_start = time.perf_counter()
+        if session_recorder is not None:
+            session_recorder.begin_trial(len(session_trials), {"eye": eye, "level": snellen_ratio, "expected": expected_direction})
+        stable_dir = wait_for_stable_hand(manager, stable_time=1.5, current_image=rotated_surface, trial_stats=trial_stats)
+        if session_recorder is not None:
+            session_recorder.end_trial({"response": stable_dir, "correct": stable_dir == expected_direction,
+                                        "input": trial_stats["input"]})
+        trial_stats.update({
+            "session_id": session_id,
+            "eye": eye,
+            "level": snellen_ratio,
+            "expected": expected_direction,
+            "response": stable_dir,
+            "correct": stable_dir == expected_direction,
+            "duration_s": round(time.perf_counter() - trial_start, 4),
+        })
+        session_trials.append(trial_stats)
         if stable_dir == expected_direction:
             correct_levels.append(snellen_ratio)
         else:
             incorrect_levels.append(snellen_ratio)
-        pygame.time.wait(500)
+        ui_pause("between_levels", on_tick=drain_capture)
     return correct_levels, incorrect_levels
 
-def main():
+def main(camera_source=None):
     global user_name, user_surname, user_age, national_id, phone, email, photo_path
     global left_eye_correct, left_eye_incorrect, right_eye_correct, right_eye_incorrect, gemini_recommendation
     global calibrated_camera_matrix, calibrated_dist_coeffs, cap, clinical_levels  # added clinical_levels
+    global session_id, session_trials, session_recorder, session_landmarks
+    session_start = time.perf_counter()
+    session_epoch = time.time()
 
-    # Select camera from available cameras
-    selected_camera = select_camera()
+    # Select camera from available cameras (or use the given index / replay recording)
+    selected_camera = camera_source if camera_source is not None else select_camera()
+    replaying = isinstance(selected_camera, str)
     if selected_camera is None:
         logging.error("No available camera found. Exiting.")
         return
-    cap = cv2.VideoCapture(selected_camera)
+    cap = open_capture(selected_camera)
 
-    # Load settings and calculate screen-related values
-    load_settings()
-    info = pygame.display.Info()
-    diag_pixels = math.sqrt(screen_width**2 + screen_height**2)
-    dpi = diag_pixels / screen_diag_in
-    mm_per_pixel = 25.4 / dpi
-    logging.info(f"In main: screen_diag_in={screen_diag_in}, DPI={dpi:.2f}, mm_per_pixel={mm_per_pixel:.4f}")
+    # Settings and mm_per_pixel were loaded at startup; later changes are pushed by the settings store
     clinical_levels = compute_font_sizes(test_distance)
 
 
@@ -1004,6 +3683,10 @@ def main():
     if is_first_run():
         show_settings_menu()
     ui_elements = show_form(manager)
+    suggestions, selected_patient, history_job = {}, None, None
+    patient_index.path = os.path.join(save_folder, "patients.jsonl")
+    BackgroundJob(patient_index.load, save_folder)
+    get_upload_engine()  # resume uploads left in the outbox by a previous run
     user_details_collected = False
     in_test = False
     measured_distance = test_distance
@@ -1023,6 +3706,20 @@ def main():
                     show_settings_menu()
             manager.process_events(event)
             if not user_details_collected:
+                if event.type == pygame.USEREVENT and event.user_type == pygame_gui.UI_TEXT_ENTRY_CHANGED:
+                    lookup_field = next((field for field, entry in LOOKUP_FIELDS.items() if ui_elements[entry] == event.ui_element), None)
+                    if lookup_field:
+                        matches = patient_index.lookup(lookup_field, event.ui_element.get_text())
+                        suggestions = {patient_label(record): record for record in matches}
+                        ui_elements["suggestion_list"].set_item_list(list(suggestions))
+                elif event.type == pygame.USEREVENT and event.user_type == pygame_gui.UI_SELECTION_LIST_NEW_SELECTION:
+                    record = suggestions.get(event.text)
+                    if record:
+                        for field, entry in FORM_FIELDS.items():
+                            ui_elements[entry].set_text(record.get(field, ""))
+                        selected_patient = record["folder"]
+                        history_job = BackgroundJob(load_patient_history, os.path.join(save_folder, selected_patient))
+                        logging.info(f"Returning patient selected: {selected_patient}")
                 if event.type == pygame.USEREVENT and event.user_type == pygame_gui.UI_BUTTON_PRESSED:
                     if event.ui_element == ui_elements["photo_button"]:
                         photo_path = select_photo()
@@ -1044,11 +3741,26 @@ def main():
                 if event.type == pygame.USEREVENT and event.user_type == pygame_gui.UI_BUTTON_PRESSED:
                     if event.ui_element == ui_elements["start_test_button"]:
                         in_test = True
+                        perf_metrics.reset()
+                        session_id = uuid.uuid4().hex[:12]
+                        session_trials = []
+                        session_landmarks = []
+                        session_start = time.perf_counter()
+                        session_epoch = time.time()
+                        # Checked before the recorder creates the patient folder
+                        returning_patient = os.path.exists(os.path.join(save_folder, f"{user_name}_{user_surname}"))
+                        if recording_enabled:
+                            recording_folder = os.path.join(save_folder, f"{user_name}_{user_surname}")
+                            os.makedirs(recording_folder, exist_ok=True)
+                            session_recorder = SessionRecorder(os.path.join(recording_folder, f"recording_{session_id}.vtrec"))
                         for element in list(ui_elements.values()):
                             element.kill()
                         show_instructions()
-                        logging.info("Starting camera calibration...")
-                        calibrated_camera_matrix, calibrated_dist_coeffs = calibrate_camera(selected_camera)
+                        if replaying:
+                            calibrated_camera_matrix, calibrated_dist_coeffs = None, None
+                        else:
+                            logging.info("Starting camera calibration...")
+                            calibrated_camera_matrix, calibrated_dist_coeffs = calibrate_camera(selected_camera)
                         if calibrated_camera_matrix is not None:
                             focal_length = calibrated_camera_matrix[0, 0]
                             logging.info(f"✓ Calibration successful - Focal length: {focal_length:.2f}px")
@@ -1059,7 +3771,7 @@ def main():
                         distance_text = get_scaled_font(30).render(f"Measured Distance: {measured_distance:.2f} m", True, BLACK)
                         screen.blit(distance_text, (200, 200))
                         pygame.display.flip()
-                        pygame.time.wait(3000)
+                        ui_pause("distance", on_tick=drain_capture)
                         adjust_font_sizes(measured_distance)
             else:
                 # Safely remove all UI elements. LayeredGUIGroup is not iterable,
@@ -1085,6 +3797,9 @@ def main():
                         pass
                 left_eye_correct, left_eye_incorrect = perform_full_test_for_eye("left", manager, measured_distance)
                 right_eye_correct, right_eye_incorrect = perform_full_test_for_eye("right", manager, measured_distance)
+                if session_recorder is not None:
+                    session_recorder.close()
+                    session_recorder = None
 
                 # Log test results
                 logging.info(f"Left Eye - Correct: {', '.join(left_eye_correct) if left_eye_correct else 'None'}")
@@ -1098,45 +3813,82 @@ def main():
                     f"Right Eye - Correct Levels: {', '.join(right_eye_correct) if right_eye_correct else 'None'}\n"
                     f"Right Eye - Incorrect Levels: {', '.join(right_eye_incorrect) if right_eye_incorrect else 'None'}"
                 )
-                ml_analysis = "No significant abnormalities detected."
-                if "10/200" in test_summary or "10/160" in test_summary:
-                    ml_analysis = "Possible risk of glaucoma. Recommend further ophthalmologic evaluation."
-                logging.info(f"ML Analysis: {ml_analysis}")
-                test_summary += f"\nML Analysis: {ml_analysis}"
-
-                screen.blit(loading_image, (0, 0))
-                loading_text = get_scaled_font(40).render("Generating AI recommendation...", True, BLACK)
-                screen.blit(loading_text, (screen_width//2 - loading_text.get_width()//2, screen_height//2 - loading_text.get_height()//2))
-                pygame.display.flip()
-                pygame.time.wait(3000)
-
-                gemini_recommendation = get_gemini_recommendation(test_summary)
-                # If the API returns a fallback message, replace it with local ML analysis
-                if "No recommendation available" in gemini_recommendation:
-                    gemini_recommendation = ml_analysis
+                local_analysis, findings = local_recommendation(left_eye_correct, right_eye_correct)
+                logging.info(f"Local analysis: {findings}")
+                test_summary += f"\nLocal Analysis:\n{local_analysis}"
+                gemini_recommendation = local_analysis
+                report_findings = findings  # cleared when Gemini text replaces the local analysis
+                user_folder = os.path.join(save_folder, f"{user_name}_{user_surname}")
+                append_acuity_history(user_folder, findings)
+                # The trend chart renders while the recommendation is prepared
+                chart_job = BackgroundJob(render_acuity_chart, user_folder)
+                # The cloud call only enriches borderline results
+                if findings["borderline"] and GEMINI_API_KEY:
+                    screen.blit(ui_assets.get("loading"), (0, 0))
+                    loading_text = get_scaled_font(40).render("Generating AI recommendation...", True, BLACK)
+                    screen.blit(loading_text, (screen_width//2 - loading_text.get_width()//2, screen_height//2 - loading_text.get_height()//2))
+                    pygame.display.flip()
+                    ai_job = BackgroundJob(get_gemini_recommendation, test_summary)
+                    ui_pause("ai_loading", until=ai_job.done)
+                    try:
+                        ai_text = ai_job.result()
+                    except Exception:
+                        ai_text = "No recommendation available due to internal API error."
+                    # Keep the local analysis if the API returns its fallback message
+                    if "No recommendation available" not in ai_text:
+                        gemini_recommendation = ai_text
+                        report_findings = None
                 logging.info("Saving test results...")
-                user_folder = f"{user_name}_{user_surname}"
-                if os.path.exists(user_folder):
-                    compare_with_previous_results(user_folder)
+                history = None
+                if returning_patient:
+                    prefetched = None
+                    if history_job and selected_patient == os.path.basename(user_folder):
+                        try:
+                            prefetched = history_job.result()
+                        except Exception:
+                            prefetched = None  # read it again below
+                    history = compare_with_previous_results(user_folder, prefetched)
+                try:
+                    chart_path = chart_job.result()
+                except Exception:
+                    chart_path = None
                 save_results(user_name, user_surname, user_age, national_id, phone, email,
                              left_eye_correct, left_eye_incorrect, right_eye_correct, right_eye_incorrect,
-                             gemini_recommendation, photo_path)
+                             gemini_recommendation, photo_path, chart_path=chart_path, history=history,
+                             findings=report_findings)
                 logging.info("Test completed and results saved successfully")
+                patient_index.add({"folder": f"{user_name}_{user_surname}", "name": user_name, "surname": user_surname,
+                                   "age": user_age, "national_id": national_id, "phone": phone, "email": email})
+                session_wall_s = time.perf_counter() - session_start
+                perf_metrics.observe("session_wall", session_wall_s)
+                logging.info(f"Session wall time: {session_wall_s:.1f}s")
+                perf_metrics.export(os.path.join(save_folder, "metrics"))
+                save_trial_log(session_trials)
+                if archive_landmarks:
+                    try:
+                        append_landmark_session(landmark_archive_path(), session_id, session_epoch, session_landmarks)
+                    except Exception as e:
+                        logging.error(f"Error archiving landmarks: {e}")
+                logging.info(f"Frame transport: {frame_transport.stats()}")
+                logging.info(f"Motion gate: {motion_gate.stats()}")
+                logging.info(f"Inference quality: {quality_controller.stats()}")
 
                 screen.fill(WHITE)
                 complete_text = get_scaled_font(30).render("Test completed. Results saved.", True, BLACK)
                 screen.blit(complete_text, (200, 200))
                 pygame.display.flip()
-                pygame.time.wait(3000)
                 if cap.isOpened():
                     cap.release()
-                cap = cv2.VideoCapture(selected_camera)
+                cap = open_capture(selected_camera)
+                ui_pause("complete")
                 left_eye_correct, left_eye_incorrect = [], []
                 right_eye_correct, right_eye_incorrect = [], []
                 in_test, user_details_collected = False, False
+                suggestions, selected_patient, history_job = {}, None, None
                 ui_elements = show_form(manager)
         # Always draw the background before drawing UI elements
-        screen.blit(background_form, (0, 0))
+        with perf_metrics.span("background_blit"):
+            screen.blit(ui_assets.get("background"), (0, 0))
         manager.update(time_delta)
         manager.draw_ui(screen)
 
@@ -1148,5 +3900,216 @@ def main():
 
         pygame.display.update()
 
+# ------------------------------
+# Multi-Station Mode
+# ------------------------------
+def apply_run_options(options):
+    """
+    Apply command-line options that live in module globals: "record",
+    "archive_landmarks" and "metrics". Used by the __main__ block and by
+    every station process.
+    """
+    global recording_enabled, archive_landmarks
+    recording_enabled = bool(options.get("record"))
+    archive_landmarks = bool(options.get("archive_landmarks"))
+    if options.get("metrics"):
+        perf_metrics.enabled = True
+
+class Station:
+    """
+    One test station: a camera (index or replay source) and a display. Each
+    station runs in its own spawned process, so the module-level state of that
+    process (screen, cap, detectors, patient and session results) belongs to
+    exactly one station.
+    """
+    def __init__(self, station_id, source, display=0, window_pos=None):
+        self.station_id = str(station_id)
+        self.source = source
+        self.display = int(display)
+        self.window_pos = window_pos
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config["id"], config["source"], config.get("display", 0), config.get("window_pos"))
+
+    def environment(self):
+        env = {"VISIONTEST_STATION": self.station_id, "VISIONTEST_DISPLAY": str(self.display)}
+        if self.window_pos:
+            env["SDL_VIDEO_WINDOW_POS"] = f"{self.window_pos[0]},{self.window_pos[1]}"
+        return env
+
+    def run(self, results=None, benchmark=False, labels_path=None, max_frames=None, client=None, options=None):
+        global inference_client
+        inference_client = client
+        # The __main__ block does not run in spawned children
+        apply_run_options(options or {})
+        if benchmark:
+            report = run_benchmark(self.source, labels_path, max_frames)
+            report["station"] = self.station_id
+            if perf_metrics.enabled:
+                report["metrics"] = perf_metrics.to_json()
+            results.put(report)
+        else:
+            main(self.source)
+
+@contextlib.contextmanager
+def _patched_environ(env):
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+def load_stations(spec, source=None):
+    """
+    Build stations from a JSON file (list of {"id", "source", "display",
+    "window_pos"}) or from a count, in which case every station uses source.
+    """
+    if str(spec).isdigit():
+        if source is None:
+            raise ValueError("A station count needs --replay or --benchmark as the source")
+        return [Station(i + 1, source) for i in range(int(spec))]
+    with open(spec, "r") as f:
+        return [Station.from_config(config) for config in json.load(f)]
+
+def run_stations(stations, benchmark=False, labels_path=None, max_frames=None, inference_workers=0, options=None):
+    """
+    Supervisor: start every station in its own spawned process and wait for
+    them. With inference_workers, stations share an InferenceServer instead of
+    loading their own graphs. options (see apply_run_options) are applied in
+    each station. In benchmark mode, returns per-station reports and
+    aggregate throughput.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue() if benchmark else None
+    server = InferenceServer(inference_workers, len(stations)) if inference_workers else None
+    processes = []
+    start = time.perf_counter()
+    for index, station in enumerate(stations):
+        client = server.client(index) if server else None
+        # Spawned children read their station/display settings at import time
+        with _patched_environ(station.environment()):
+            process = ctx.Process(target=station.run,
+                                  args=(results, benchmark, labels_path, max_frames, client, options),
+                                  name=f"station-{station.station_id}")
+            process.start()
+        processes.append((station, process))
+        logging.info(f"Station {station.station_id} started (pid {process.pid}, source {station.source})")
+
+    reports = []
+    while benchmark and len(reports) < len(processes):
+        try:
+            reports.append(results.get(timeout=1.0))
+        except queue.Empty:
+            if not any(process.is_alive() for _, process in processes):
+                break
+    for station, process in processes:
+        process.join()
+        if process.exitcode:
+            logging.error(f"Station {station.station_id} exited with code {process.exitcode}")
+    wall_s = time.perf_counter() - start
+    inference_metrics = server.metrics() if server else None
+    if server:
+        server.shutdown()
+    if not benchmark:
+        return None
+
+    total_frames = sum(report["frames"] for report in reports)
+    return {
+        "stations": len(stations),
+        "wall_s": round(wall_s, 3),
+        "total_frames": total_frames,
+        "aggregate_fps": round(total_frames / wall_s, 2) if wall_s > 0 else 0.0,
+        "per_station": sorted(reports, key=lambda report: report["station"]),
+        "inference_server": inference_metrics,
+    }
+
+def write_report(report, output_path=None):
+    """
+    Print a JSON report and optionally write it to output_path.
+    """
+    report_text = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(report_text)
+    print(report_text)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="M-Tech Clinical Vision Test")
+    parser.add_argument("--replay", help="video file or image directory to use instead of a camera")
+    parser.add_argument("--benchmark", help="video file or image directory to benchmark headlessly")
+    parser.add_argument("--labels", help="CSV of 'frame,direction' labels for --benchmark accuracy")
+    parser.add_argument("--max-frames", type=int, default=None, help="limit frames processed by --benchmark")
+    parser.add_argument("--check-inference-server", action="store_true",
+                        help="with --benchmark, compare shared-server directions with the local path")
+    parser.add_argument("--motion-gate", action="store_true", help="with --benchmark, gate inference on motion and compare with ungated")
+    parser.add_argument("--output", help="write the --benchmark or --trial-report report to this JSON file")
+    parser.add_argument("--headless", action="store_true", help="run without a display (SDL dummy driver)")
+    parser.add_argument("--stations", help="run several stations: a JSON station file, or a count using the --replay/--benchmark source")
+    parser.add_argument("--inference-workers", type=int, default=0, help="with --stations, share a pool of N inference processes")
+    parser.add_argument("--trial-report", nargs="?", const=True, default=None, metavar="TRIALS_JSONL",
+                        help="print trial latency analytics (defaults to results/analytics/trials.jsonl)")
+    parser.add_argument("--record", action="store_true", help="record each trial's response window for audit (.vtrec in the patient folder)")
+    parser.add_argument("--archive-landmarks", action="store_true", help="append every session's hand landmarks to the landmark archive")
+    parser.add_argument("--landmark-analysis", nargs="?", const=True, default=None, metavar="STORE",
+                        help="recompute directions over the landmark archive (defaults to results/analytics/landmarks)")
+    parser.add_argument("--bin-edges", type=float, nargs=4, default=(45.0, 135.0, 225.0, 315.0),
+                        help="angle bin edges for --landmark-analysis")
+    parser.add_argument("--probe-camera", type=int, default=None, metavar="INDEX",
+                        help="measure the capture profiles of a camera and save the lowest-latency one")
+    parser.add_argument("--flush-uploads", action="store_true", help="send everything left in the upload outbox, then exit")
+    parser.add_argument("--upload-timeout", type=float, default=300.0,
+                        help="with --flush-uploads, give up after this many seconds (exit code 1 if uploads remain)")
+    parser.add_argument("--ui-asset-report", action="store_true", help="time UI asset loading and background blits, then exit")
+    parser.add_argument("--metrics", action="store_true", help="record per-stage timing histograms for each session")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve metrics on http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args()
+    run_options = {"record": args.record, "archive_landmarks": args.archive_landmarks,
+                   "metrics": bool(args.metrics or args.metrics_port)}
+    apply_run_options(run_options)
+    if args.metrics_port:
+        perf_metrics.serve(args.metrics_port)
+    if args.ui_asset_report:
+        write_report(ui_asset_report(), args.output)
+    elif args.flush_uploads:
+        engine = get_upload_engine()
+        if engine is None:
+            raise SystemExit("No upload_target set in the settings file")
+        flushed = engine.flush(args.upload_timeout)
+        stats = engine.stats()
+        engine.stop()
+        write_report(stats, args.output)
+        if not flushed or stats["pending"]:
+            logging.error(f"{stats['pending']} upload(s) still pending after {args.upload_timeout:.0f}s")
+            sys.exit(1)
+    elif args.probe_camera is not None:
+        write_report({"camera": args.probe_camera, "profiles": probe_capture_profiles(args.probe_camera),
+                      "selected": settings_store.get("capture_profiles").get(camera_key(args.probe_camera))},
+                     args.output)
+    elif args.landmark_analysis:
+        store_path = landmark_archive_path() if args.landmark_analysis is True else args.landmark_analysis
+        write_report(landmark_analysis_report(store_path, tuple(args.bin_edges)), args.output)
+    elif args.trial_report:
+        trials_path = trial_log_path() if args.trial_report is True else args.trial_report
+        write_report(trial_analytics_report(load_trial_log(trials_path)), args.output)
+    elif args.stations:
+        stations = load_stations(args.stations, args.benchmark or args.replay)
+        report = run_stations(stations, bool(args.benchmark), args.labels, args.max_frames, args.inference_workers,
+                              run_options)
+        if report is not None:
+            write_report(report, args.output)
+    elif args.benchmark:
+        report = run_benchmark(args.benchmark, args.labels, args.max_frames, MotionGate() if args.motion_gate else None)
+        if args.check_inference_server:
+            report["inference_server_check"] = check_inference_server(args.benchmark, args.max_frames,
+                                                                      max(1, args.inference_workers))
+        if perf_metrics.enabled:
+            report["metrics"] = perf_metrics.to_json()
+        write_report(report, args.output)
+    else:
+        main(args.replay)
\ No newline at end of file